@@ -16,11 +16,27 @@
 
 
 from os import path
-import pygame
+
+
+_images = {}
 
 
 def _load(file_name):
-  return pygame.image.load(path.abspath(path.join(path.dirname(__file__), file_name)))
+  image = _images.get(file_name)
+  if image is None:
+    import pygame
+    image = pygame.image.load(path.abspath(path.join(path.dirname(__file__), file_name)))
+    if pygame.display.get_surface() is not None:
+      image = image.convert_alpha()
+    _images[file_name] = image
+  return image
+
+
+def preload():
+  """Loads all images, converted to the pixel format of the display, which must already be set."""
+  _images.clear()
+  correct_image()
+  error_image()
 
 
 def correct_image():
@@ -56,6 +56,22 @@ class TestSettings(unittest.TestCase):
         self.assertEqual(s.show_feedback, True)
         self.assertEqual(s.show_scores, True)
         self.assertEqual(s.score_font, 'monospace')
+        self.assertEqual(s.max_factor, 10)
+        self.assertEqual(s.background_save, False)
+        self.assertEqual(s.prerender, False)
+        self.assertEqual(s.prefetch, False)
+        self.assertEqual(s.scheduler, 'sampling')
+
+    def test_max_factor(self):
+        settings_backend = dict()
+        fs = SomeSettingsFS(settings_backend)
+        args = tabliczka.get_argument_parser().parse_args(['--max-factor', '20'])
+        s = tabliczka.Settings(fs, args)
+        self.assertEqual(s.max_factor, 20)
+        self.assertDictEqual(settings_backend, dict(max_factor=20))
+
+        s = tabliczka.Settings(fs, tabliczka.get_argument_parser().parse_args([]))
+        self.assertEqual(s.max_factor, 20)
 
     def test_settings_from_fs(self):
         fs = SomeSettingsFS(dict(
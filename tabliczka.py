@@ -18,38 +18,111 @@
 
 
 import argparse
+import array
+import bisect
+import collections
+import contextlib
+import datetime
+import functools
+import heapq
 import itertools
 import json
 import logging
+import math
+import mmap
 import pickle
 import os
-import pygame
 import random
+import re
+import struct
+import sys
+import threading
 import time
+import urllib.parse
 
 import data
 
 
-_NUMBERS = range(1, 11)
+_DEFAULT_MAX_FACTOR = 10
 _ERROR_FEEDBACK_DELAY_MILLISEC = 2*1000
 _FREQ_UNKNOWN = 101
 _FREQ_MAX = 100
 _ANSWER_SEC_MAX = 10
 _FREQ_QUICK = 1
 _ANSWER_SEC_QUICK= 2
+_FREQ_LATEST_WEIGHT = 0.5  # How much the latest answer counts, compared to all the previous ones.
+_DUE_INTERVAL_SCALE = 300  # Number of answers before a question with frequency 1 is due again.
+_DEFAULT_SCHEDULER = 'sampling'
 _DEFAULT_SCORE_FONT = 'monospace'
 _DEFAULT_ANSWER_SCHEME = 'NESW'
-
-_KEYS_ARROWS = (pygame.K_UP, pygame.K_RIGHT, pygame.K_DOWN, pygame.K_LEFT)
-# The order of the following matches the order of the above.
+_JOURNAL_COMPACT_RECORDS = 1000
+_TEXT_CACHE_SIZE = 1000
+_WRONG_ANSWER_COUNT = 3  # Enough for any answer scheme.
+# Number of questions drawn at once when generating a worksheet.
+_GENERATE_BATCH_SIZE = 1024
+_DEFAULT_SERVER_PORT = 8462
+_METRICS_FILE_INTERVAL_SEC = 15
+# Upper bounds of stage latency histogram buckets, in seconds.
+_METRICS_BUCKETS_SEC = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+_METRICS_STAGES = ('generate_problem', 'render', 'flip', 'update_from', 'save')
+_SERVER_IDLE_TIMEOUT_SEC = 10*60
+_SERVER_LINE_LIMIT = 1024
+_LEARNER_NAME = re.compile(r'[A-Za-z0-9_-]{1,32}$')
+# The journal starts with the generation of the state file it applies to,
+# followed by one record per answer: factors, new frequency, correctness.
+_JOURNAL_HEADER = struct.Struct('<Q')
+_JOURNAL_RECORD = struct.Struct('<HHd?')
+# The state file starts with a header: magic bytes, format version, table size,
+# correct count, error count and generation. It is followed by the frequency
+# of each question a * b, for a and b from 1 to size, in row-major order,
+# as little-endian IEEE 754 doubles. All numbers in the header are little-endian.
+# Since version 2, it is followed by the due time of each question, in the same
+# order and format, as a count of answers.
+_STATE_MAGIC = b'TABL'
+_STATE_VERSION = 2
+_STATE_HEADER = struct.Struct('<4sHHQQQ')
+# The answer log starts with magic bytes and format version. It is followed
+# by blocks, each with a record count, followed by the values of each column
+# of the records in turn. A chosen answer which is not a number, or does not fit
+# in the column, is stored as -1.
+_ANSWER_LOG_MAGIC = b'TLOG'
+_ANSWER_LOG_VERSION = 1
+_ANSWER_LOG_HEADER = struct.Struct('<4sH')
+_ANSWER_LOG_BLOCK_HEADER = struct.Struct('<I')
+_ANSWER_LOG_COLUMNS = (
+    ('a', 'H'),
+    ('b', 'H'),
+    ('answer', 'i'),
+    ('correct', 'B'),
+    ('latency', 'f'),  # seconds
+    ('timestamp', 'd'),  # seconds since the epoch
+)
+# Upper bounds of answer latency histogram buckets, in seconds, growing exponentially up to about 100.
+_LATENCY_BUCKETS = tuple(0.1 * 2**(i/4) for i in range(41))
+_ANSWER_LOG_ANSWER_MAX = 2**31 - 1
+
+# The order of the following matches the order of arrow keys in _keys_arrows().
 _KEYS_MINECRAFT_LOWER = 'wdsa'
 _KEYS_MINECRAFT_UPPER = 'WDSA'
 
 _home = os.path.expanduser('~')
 _xdg_state_home = os.environ.get('XDG_STATE_HOME') or os.path.join(_home, '.local', 'state')
 _state_home = os.path.join(_xdg_state_home, 'tabliczka')
-_state_file = os.path.join(_state_home, 'state.pickle')
+_STATE_FILE_NAME = 'state.bin'
+_LEGACY_STATE_FILE_NAME = 'state.pickle'
+_JOURNAL_FILE_NAME = 'state.journal'
+_ANSWER_LOG_FILE_NAME = 'answers.log'
+_state_file = os.path.join(_state_home, _STATE_FILE_NAME)
+_journal_file = os.path.join(_state_home, _JOURNAL_FILE_NAME)
+_answer_log_file = os.path.join(_state_home, _ANSWER_LOG_FILE_NAME)
 _settings_filename = os.path.join(_state_home, 'settings.json')
+_profiles_filename = os.path.join(_state_home, 'profiles.sqlite')
+_font_cache_filename = os.path.join(_state_home, 'fonts.json')
+# Installing or removing fonts changes modification times of some of these.
+_FONT_DIRS = [os.path.join(_home, *d) for d in (
+    ('.fonts',), ('.local', 'share', 'fonts'), ('.cache', 'fontconfig'), ('Library', 'Fonts'))] + [
+    '/usr/share/fonts', '/usr/local/share/fonts', '/var/cache/fontconfig', '/Library/Fonts', '/System/Library/Fonts',
+    os.path.join(os.environ.get('WINDIR', 'C:\\Windows'), 'Fonts')]
 
 
 class QuitException(Exception):
@@ -60,20 +133,45 @@ def get_argument_parser():
     parser = argparse.ArgumentParser()
 
     # Options mostly useful for an interactive terminal user.
-    parser.add_argument('--ui', choices=['cli', 'gui'])
+    parser.add_argument('--ui', choices=['cli', 'tui', 'gui', 'server'])
+    parser.add_argument('--port', type=int, default=_DEFAULT_SERVER_PORT, help='Port for the server UI to listen on, on localhost only.')
     parser.add_argument('--dump', action='store_true', help='Just show the saved state and quit.')
+    parser.add_argument('--stats', action='store_true', help='Just show statistics of all answers given so far and quit.')
+    parser.add_argument('--generate', type=int, metavar='N', help='Just print a worksheet of N questions, weighted by the saved state, and quit.')
+    parser.add_argument('--output', help='File to write the worksheet to (defaults to standard output).')
+    parser.add_argument('--record', metavar='FILE', help='Record the GUI session to FILE, for replaying it later.')
+    parser.add_argument('--replay', metavar='FILE', help='Just replay the GUI session recorded in FILE without showing it, report how long displaying took, and quit.')
+    parser.add_argument('--report', nargs='+', metavar='DIR', help='Just write a report on all learners with state saved under the given directories, and quit.')
+    parser.add_argument('--report-format', choices=['csv', 'json'], default='csv', help='Format of the report.')
+    parser.add_argument('--report-output', metavar='DIR', default='.', help='Directory to write report files to.')
     parser.add_argument('--debug', action='store_true', help='Turn on debug-level logging.')
+    parser.add_argument('--metrics-port', type=int, help='Serve metrics in Prometheus format over HTTP on this port, on localhost only.')
+    parser.add_argument('--metrics-file', help='Write metrics in Prometheus format to this file, every %d seconds.' % _METRICS_FILE_INTERVAL_SEC)
+    parser.add_argument('--trace', metavar='FILE', help='Write timings of each stage to FILE, in Chrome trace event format.')
+    parser.add_argument('--profile', help='Keep settings and progress in the named profile, in a database shared by all profiles.')
     parser.add_argument('--repl', action='store_true', help='Start the REPL before main program.')
     # Options that control behaviour. These are persisted in the settings file.
     parser.add_argument('--limit', type=int, help='Quit after correctly solving this many questions (0 means no limit).')
     parser.add_argument('--show-feedback', action=argparse.BooleanOptionalAction, help='Show feedback on wrong answers.')
     parser.add_argument('--show-scores', action=argparse.BooleanOptionalAction, help='Show scores in main window.')
     parser.add_argument('--score-font', help='Font to use for displaying scores (defaults to %s).' % _DEFAULT_SCORE_FONT)
+    parser.add_argument('--background-save', action=argparse.BooleanOptionalAction, help='Save progress in a background thread.')
+    parser.add_argument('--prerender', action=argparse.BooleanOptionalAction, help='Render texts for the whole table at startup.')
+    parser.add_argument('--prefetch', action=argparse.BooleanOptionalAction, help='Prepare the next question while the current one is being answered.')
+    parser.add_argument('--max-factor', type=_max_factor, help='Ask questions with factors up to this number (defaults to %d).' % _DEFAULT_MAX_FACTOR)
+    parser.add_argument('--scheduler', choices=['sampling', 'due'], help='How to choose questions: at random, more often the more difficult they are (sampling), or each when it is due again, sooner the more difficult it is (due); defaults to %s.' % _DEFAULT_SCHEDULER)
     parser.add_argument('--answer-scheme', choices=[_DEFAULT_ANSWER_SCHEME, 'EW'], default=None, help='Where to show possible answers (letters stand for geographic directions relative to displayed question).')
 
     return parser
 
 
+def _max_factor(value):
+    n = int(value)
+    if n < 2:
+        raise argparse.ArgumentTypeError('must be at least 2')
+    return n
+
+
 class FS:
     def read(self):
         try:
@@ -88,6 +186,33 @@ class FS:
             json.dump(settings, settings_file)
 
 
+class MemoryFS:
+    """Keeps settings in memory only."""
+
+    def __init__(self, settings=None):
+        self.settings = settings
+
+    def read(self):
+        return self.settings
+
+    def write(self, settings):
+        self.settings = settings
+
+
+class ProfileFS:
+    """Reads and writes settings of a profile in the profile store."""
+
+    def __init__(self, store, name):
+        self._store = store
+        self._name = name
+
+    def read(self):
+        return self._store.read_settings(self._name)
+
+    def write(self, settings):
+        self._store.write_settings(self._name, settings)
+
+
 def main():
 
     parser = get_argument_parser()
@@ -98,33 +223,96 @@ def main():
             format='%(levelname).1s%(asctime)s.%(msecs)03d] %(message)s',
             datefmt='%m%d %H:%M:%S')
 
+    global _tracer, _metrics
+    tracer = Tracer() if args.trace else None
+    if args.metrics_port is not None or args.metrics_file:
+        _metrics = Metrics()
+        _metrics.export(args.metrics_port, args.metrics_file)
+    _tracer = _span_recorder(tracer, _metrics)
+    try:
+        _main(args)
+    finally:
+        if tracer is not None:
+            tracer.write(args.trace)
+        if _metrics is not None:
+            _metrics.stop()
+
+
+def _main(args):
+    with contextlib.closing(ProfileStore(_profiles_filename)) if args.profile else contextlib.nullcontext() as store:
+        _run_command(args, store)
+
+
+def _run_command(args, store):
     if args.dump:
-        State.load().dump()
+        (State.load_profile(store, args.profile) if store else State.load()).dump()
+        return
+
+    if args.stats:
+        print_stats(store.answer_log_file_name(args.profile) if store else _answer_log_file)
+        return
+
+    if args.report:
+        write_report(args.report, args.report_output, args.report_format)
+        return
+
+    if args.replay:
+        matches, frame_count, display_sec = replay_session(args.replay)
+        print('Rendered %d frames, %.2f msec per frame on average.' % (
+            frame_count, 1000 * display_sec / frame_count if frame_count else 0))
+        if not matches:
+            sys.exit('Replay ended in a different state than the recorded session.')
         return
 
     if args.repl:
         import code
         code.interact()
 
-    fs = FS()
-    settings = Settings(fs, args)
+    fs = ProfileFS(store, args.profile) if store else FS()
+    with _trace('settings'):
+        settings = Settings(fs, args)
+
+    if args.generate is not None:
+        state = State.load_profile(store, args.profile, settings.max_factor) if store else State.load(settings.max_factor)
+        state.use_scheduler(settings.scheduler)
+        with (open(args.output, "w") if args.output else contextlib.nullcontext(sys.stdout)) as output:
+            write_worksheet(state, args.generate, len(settings.answer_scheme), output)
+        return
+
+    if args.ui == 'server':
+        import asyncio
+        try:
+            asyncio.run(Server(settings).serve(args.port))
+        except KeyboardInterrupt:
+            pass
+        return
+
+    if args.record:
+        if args.ui in ('cli', 'tui'):
+            sys.exit('Only GUI sessions can be recorded.')
+        state = State.load_profile(store, args.profile, settings.max_factor) if store else State.load(settings.max_factor)
+        record_session(settings, state, args.record)
+        return
 
+    with _trace('load'):
+        state = State.load_profile(store, args.profile, settings.max_factor) if store else None
     with get_ui_class(args.ui)(settings) as ui:
         try:
-            run(ui, settings)
+            run(ui, settings, state)
         except QuitException:
             pass
 
 
 def get_ui_class(ui_name):
-    return CLI if ui_name == 'cli' else GUI
+    return dict(cli=CLI, tui=TUI).get(ui_name, GUI)
 
 
 class Settings:
 
     def __init__(self, fs, parsed_args):
         self._s = dict((k, None) for k in [
-            'limit', 'show_scores', 'show_feedback', 'score_font', 'answer_scheme'])
+            'limit', 'show_scores', 'show_feedback', 'score_font', 'answer_scheme', 'max_factor',
+            'background_save', 'prerender', 'prefetch', 'scheduler'])
         self._load_settings(fs)
         self._merge_settings(parsed_args)
         self._save_settings(fs)
@@ -149,6 +337,26 @@ class Settings:
     def answer_scheme(self):
         return self._s['answer_scheme'] or _DEFAULT_ANSWER_SCHEME
 
+    @property
+    def max_factor(self):
+        return self._s['max_factor'] or _DEFAULT_MAX_FACTOR
+
+    @property
+    def background_save(self):
+        return bool(self._s['background_save'])
+
+    @property
+    def prerender(self):
+        return bool(self._s['prerender'])
+
+    @property
+    def prefetch(self):
+        return bool(self._s['prefetch'])
+
+    @property
+    def scheduler(self):
+        return self._s['scheduler'] or _DEFAULT_SCHEDULER
+
     def _load_settings(self, fs):
         loaded = fs.read()
         if not loaded:
@@ -164,25 +372,267 @@ class Settings:
                 self._s[s] = override
 
     def _save_settings(self, fs):
-        fs.write(dict(kv for kv in self._s.items() if kv[1] is not None))
+        fs.write(self.to_dict())
+
+    def to_dict(self):
+        return dict(kv for kv in self._s.items() if kv[1] is not None)
 
 
 def _truthify(setting):
     return True if setting is None else setting
 
 
-def run(ui, settings):
-    state = State.load()
+def run(ui, settings, state=None):
+    if state is None:
+        with _trace('load'):
+            state = State.load(settings.max_factor, migrate=True)
+    state.use_scheduler(settings.scheduler)
+    if settings.background_save:
+        state.save_in_background()
+    if _metrics is not None:
+        _metrics.watch(state)
     limit = settings.limit
-    while limit is None or limit > 0:
-        problem = state.generate_problem(ui.answer_count())
-        ui.solve_problem(problem, state)
-        state.update_from(problem)
-        if not problem.answered_correctly():
-            ui.provide_feedback(problem, state)
-        elif limit is not None:
-            limit -= 1
-        state.save()
+    answer_count = 0
+    feedback_sec = 0
+    start = time.monotonic()
+    try:
+        while limit is None or limit > 0:
+            with _trace('generate_problem'):
+                problem = state.generate_problem(ui.answer_count())
+            ui.solve_problem(problem, state)
+            answer_count += 1
+            with _trace('update_from'):
+                state.update_from(problem)
+            if not problem.answered_correctly():
+                feedback_start = time.monotonic()
+                ui.provide_feedback(problem, state)
+                feedback_sec += time.monotonic() - feedback_start
+            elif limit is not None:
+                limit -= 1
+            with _trace('save'):
+                state.save()
+    finally:
+        state.compact()
+        _log_session_summary(answer_count, time.monotonic() - start, feedback_sec)
+
+
+def _log_session_summary(answer_count, session_sec, feedback_sec):
+    """Logs the number of questions answered per minute, with and without time spent showing feedback."""
+    if not answer_count or not session_sec:
+        return
+    logging.info('Answered %d questions in %.1f minutes: %.1f per minute, %.1f per minute without the %.1f seconds of feedback.',
+            answer_count, session_sec / 60, 60 * answer_count / session_sec,
+            60 * answer_count / max(session_sec - feedback_sec, 1e-9), feedback_sec)
+
+
+class Tracer:
+    """Records spans of time, to be written in Chrome trace event format."""
+
+    def __init__(self):
+        self._origin = time.perf_counter_ns()
+        self._spans = []  # (name, thread, start, duration), in nanoseconds since origin
+
+    @contextlib.contextmanager
+    def span(self, name):
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            end = time.perf_counter_ns()
+            self._spans.append((name, threading.get_ident(), start - self._origin, end - start))
+
+    def write(self, file_name):
+        pid = os.getpid()
+        events = [dict(name=name, ph='X', pid=pid, tid=thread, ts=start / 1000, dur=duration / 1000)
+                  for name, thread, start, duration in self._spans]
+        with open(file_name, "w") as trace_file:
+            json.dump(dict(traceEvents=events, displayTimeUnit='ms'), trace_file)
+
+
+class Metrics:
+    """Counts answers and times stages, for exporting in Prometheus text format.
+
+    Each histogram is only updated by the thread running its stage, and
+    exporting reads it without taking any lock, so a scrape never blocks
+    the session. A scrape may see a stage counted before its time is.
+    """
+
+    def __init__(self):
+        self._histograms = dict((stage, _Histogram()) for stage in _METRICS_STAGES)
+        self._state = None
+        self._server = None
+        self._stop = threading.Event()
+        self._threads = []
+
+    def watch(self, state):
+        """Exports the answer counts of the given state."""
+        self._state = state
+
+    def span(self, name):
+        histogram = self._histograms.get(name)
+        return _no_span if histogram is None else histogram.timer()
+
+    def text(self):
+        lines = [
+            '# HELP tabliczka_answers_total Answers given since the program started.',
+            '# TYPE tabliczka_answers_total counter',
+            'tabliczka_answers_total %d' % self._histograms['update_from'].count,
+        ]
+        state = self._state
+        if state is not None:
+            lines += [
+                '# HELP tabliczka_correct_answers_total Correct answers given by the learner, ever.',
+                '# TYPE tabliczka_correct_answers_total counter',
+                'tabliczka_correct_answers_total %d' % state.correct_count(),
+                '# HELP tabliczka_error_answers_total Incorrect answers given by the learner, ever.',
+                '# TYPE tabliczka_error_answers_total counter',
+                'tabliczka_error_answers_total %d' % state.error_count(),
+            ]
+        lines += [
+            '# HELP tabliczka_stage_seconds Time taken by each stage of asking a question.',
+            '# TYPE tabliczka_stage_seconds histogram',
+        ]
+        for stage, histogram in self._histograms.items():
+            lines += histogram.lines('tabliczka_stage_seconds', 'stage="%s"' % stage)
+        rss = _resident_memory_bytes()
+        if rss is not None:
+            lines += [
+                '# HELP process_resident_memory_bytes Resident memory size in bytes.',
+                '# TYPE process_resident_memory_bytes gauge',
+                'process_resident_memory_bytes %d' % rss,
+            ]
+        return '\n'.join(lines) + '\n'
+
+    def export(self, port=None, file_name=None):
+        """Serves metrics over HTTP on localhost, and/or writes them to a file periodically, on separate threads."""
+        if port is not None:
+            import http.server
+            metrics = self
+
+            class Handler(http.server.BaseHTTPRequestHandler):
+
+                def do_GET(self):
+                    body = metrics.text().encode()
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format, *args):
+                    logging.debug('Metrics request: ' + format, *args)
+
+            self._server = http.server.ThreadingHTTPServer(('localhost', port), Handler)
+            self._threads.append(threading.Thread(target=self._server.serve_forever, name='metrics-server', daemon=True))
+        if file_name:
+            self._threads.append(threading.Thread(
+                target=self._write_periodically, args=(file_name,), name='metrics-writer', daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def port(self):
+        return self._server.server_address[1]
+
+    def stop(self):
+        self._stop.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+        for thread in self._threads:
+            thread.join()
+
+    def _write_periodically(self, file_name):
+        while True:
+            stopping = self._stop.wait(_METRICS_FILE_INTERVAL_SEC)
+            try:
+                with _atomic_write(file_name) as metrics_file:
+                    metrics_file.write(self.text().encode())
+            except OSError as e:
+                logging.warning('Failed to write metrics: %s', e)
+            if stopping:
+                return
+
+
+class _Histogram:
+
+    def __init__(self):
+        self.buckets = array.array('Q', [0]) * (len(_METRICS_BUCKETS_SEC) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.buckets[bisect.bisect_left(_METRICS_BUCKETS_SEC, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def timer(self):
+        return _HistogramTimer(self)
+
+    def lines(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(_METRICS_BUCKETS_SEC + ('+Inf',), self.buckets):
+            cumulative += bucket_count
+            lines.append('%s_bucket{%s,le="%s"} %d' % (name, labels, bound, cumulative))
+        lines.append('%s_sum{%s} %r' % (name, labels, self.sum))
+        lines.append('%s_count{%s} %d' % (name, labels, self.count))
+        return lines
+
+
+class _HistogramTimer:
+
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self._histogram.observe(time.perf_counter() - self._start)
+
+
+def _resident_memory_bytes():
+    """Returns the resident memory size of this process, or None if it is not known on this platform."""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+class _SpanRecorders:
+    """Records each span with several recorders."""
+
+    def __init__(self, recorders):
+        self._recorders = recorders
+
+    def span(self, name):
+        spans = contextlib.ExitStack()
+        for recorder in self._recorders:
+            spans.enter_context(recorder.span(name))
+        return spans
+
+
+def _span_recorder(*recorders):
+    recorders = [r for r in recorders if r is not None]
+    if len(recorders) > 1:
+        return _SpanRecorders(recorders)
+    return recorders[0] if recorders else None
+
+
+_tracer = None
+_metrics = None
+_no_span = contextlib.nullcontext()
+
+
+def _trace(name):
+    """Returns a context manager which records a span, if tracing or metrics are enabled."""
+    return _no_span if _tracer is None else _tracer.span(name)
+
+
+def due_interval(frequency):
+    """Returns the number of answers after which a question with the given frequency is due again."""
+    return _DUE_INTERVAL_SCALE / frequency
 
 
 def frequency(answer_delay):
@@ -196,73 +646,276 @@ def frequency(answer_delay):
 class State:
 
     @classmethod
-    def load(cls):
+    def load(cls, max_factor=None, state_home=None, migrate=False):
+        """Loads state from the given directory, or the default one.
+
+        State written by older versions is read if there is no other. It is
+        only converted to the current format if migrate is true, so that
+        commands which do not save anything leave the files alone.
+        """
+        _, state_file, journal_file = _state_files(state_home)
+        legacy_state_file = os.path.join(os.path.dirname(state_file), _LEGACY_STATE_FILE_NAME)
+        legacy = not os.path.exists(state_file) and os.path.exists(legacy_state_file)
         try:
-            return cls.load_from(_state_file)
+            if legacy:
+                state = cls.load_legacy_from(legacy_state_file, max_factor)
+            else:
+                state = cls.load_from(state_file, max_factor, journal_file)
         except Exception as e:
             logging.warning('Failed to load state, creating empty state: %s' % e)
-            return cls()
+            state = cls(max_factor=max_factor)
+            legacy = False
+        state._storage = FileStorage(state_home)
+        if legacy and migrate:
+            logging.info('Converting %s to %s.', legacy_state_file, state_file)
+            state.compact()
+            os.remove(legacy_state_file)
+        return state
 
     @classmethod
-    def load_from(cls, state_filename):
-        with open(state_filename, "rb") as state_file:
-            frequency_map = pickle.load(state_file)
-            try:
-                correct_count = pickle.load(state_file)
-                error_count = pickle.load(state_file)
-            except Exception:
-                correct_count = 0
-                error_count = 0
-            return cls(frequency_map, correct_count, error_count)
-
-    def __init__(self, frequency_map=None, correct_count=0, error_count=0):
-        if frequency_map:
-            self._frequency_map = frequency_map
+    def load_profile(cls, store, name, max_factor=None):
+        """Loads state of the named profile from the profile store."""
+        saved = store.read_state(name)
+        if saved:
+            frequencies, correct_count, error_count, dues = saved
+            state = cls(frequencies, correct_count, error_count, max_factor, dues=dues)
         else:
-            self._frequency_map = dict((q, _FREQ_UNKNOWN) for q in itertools.product(_NUMBERS, _NUMBERS))
+            state = cls(max_factor=max_factor)
+        state._storage = ProfileStorage(store, name)
+        return state
+
+    @classmethod
+    def load_legacy_from(cls, state_filename, max_factor=None):
+        """Loads a state file written by older versions, which had no journal."""
+        with open(state_filename, "rb") as state_file:
+            frequencies, correct_count, error_count = _read_legacy_state(state_file)
+        return cls(frequencies, correct_count, error_count, max_factor)
+
+    @classmethod
+    def load_from(cls, state_filename, max_factor=None, journal_filename=None):
+        with open(state_filename, "rb") as state_file:
+            if state_file.read(len(_STATE_MAGIC)) != _STATE_MAGIC:
+                raise ValueError('%s is not a state file' % state_filename)
+            frequencies, correct_count, error_count, generation, dues = _read_state(state_file)
+        records = _read_journal(journal_filename, generation) if journal_filename else []
+        size = math.isqrt(len(frequencies))
+        journal_size = max((max(r[0], r[1]) for r in records), default=0)
+        if journal_size > size:
+            frequencies = _resized_frequencies(frequencies, size, journal_size)
+            dues = _resized_frequencies(dues, size, journal_size, 0.0) if dues else None
+        state = cls(frequencies, correct_count, error_count, max_factor, generation, dues)
+        for record in records:
+            state._apply(*record)
+        return state
+
+    def __init__(self, frequencies=None, correct_count=0, error_count=0, max_factor=None, generation=0, dues=None):
+        """Creates state from a flat array of question frequencies.
+
+        The frequency of question a * b is stored at index (a-1)*size + (b-1),
+        where size is the largest factor seen so far. Questions with factors
+        above max_factor are kept, but never asked. The table is grown if
+        max_factor is larger than size. Due times, counted in answers, are
+        stored the same way; all questions are due at first.
+        """
+        size = math.isqrt(len(frequencies)) if frequencies else 0
+        self._max_factor = max_factor or size or _DEFAULT_MAX_FACTOR
+        if not dues:
+            dues = array.array('d', [0.0]) * (size * size)
+        if size < self._max_factor:
+            frequencies = _resized_frequencies(frequencies, size, self._max_factor)
+            dues = _resized_frequencies(dues, size, self._max_factor, 0.0)
+            size = self._max_factor
+        self._frequencies = frequencies
+        self._dues = dues
+        self._size = size
         self._correct_count = correct_count
         self._error_count = error_count
+        self._generation = generation
+        self._journal_records = None  # Not counted until the whole state is written in this session.
+        self._unsaved_records = []
+        self._unsaved_answers = []
+        self._writer = None
+        self._owns_writer = False
+        self._storage = FileStorage()
         self._last_generated = None  # We do not bother storing this across executions.
+        self._prefetched = None
+        self._scheduler_name = _DEFAULT_SCHEDULER
+        self._scheduler = self._new_scheduler()
+
+    def use_scheduler(self, name):
+        """Switches to choosing questions with the named scheduler, one of _SCHEDULERS."""
+        if name != self._scheduler_name:
+            self._scheduler_name = name
+            self._scheduler = self._new_scheduler()
+            self._prefetched = None
+
+    def _new_scheduler(self):
+        if self._max_factor == self._size:
+            weights = self._frequencies
+        else:
+            weights = (f if self._is_asked(i) else 0 for i, f in enumerate(self._frequencies))
+        return _SCHEDULERS[self._scheduler_name](weights, self._dues)
+
+    def _index(self, question):
+        a, b = question
+        return (a - 1) * self._size + (b - 1)
+
+    def _question(self, index):
+        a, b = divmod(index, self._size)
+        return a + 1, b + 1
+
+    def _is_asked(self, index):
+        a, b = self._question(index)
+        return a <= self._max_factor and b <= self._max_factor
+
+    def max_factor(self):
+        return self._max_factor
 
     def _update_frequency(self, question, latest_frequency):
-        previous = self._frequency_map[question]
+        index = self._index(question)
+        previous = self._frequencies[index]
         if previous == _FREQ_UNKNOWN:
             new = latest_frequency
         else:
-            new = (previous + latest_frequency) / 2
-        self._frequency_map[question] = new
+            new = (1 - _FREQ_LATEST_WEIGHT) * previous + _FREQ_LATEST_WEIGHT * latest_frequency
+        self._frequencies[index] = new
+        self._dues[index] = due = self._correct_count + self._error_count + due_interval(new)
+        self._scheduler.update(index, new, due)
+        return new
+
+    def _apply(self, a, b, new_frequency, correct):
+        """Replays a journal record."""
+        index = self._index((a, b))
+        self._frequencies[index] = new_frequency
+        self._dues[index] = due = self._correct_count + self._error_count + due_interval(new_frequency)
+        if self._is_asked(index):
+            self._scheduler.update(index, new_frequency, due)
+        if correct:
+            self._correct_count += 1
+        else:
+            self._error_count += 1
 
     def update_from(self, problem):
         q = problem._question()
+        if q != self._last_generated:
+            self._prefetched = None  # It was drawn with this question's old weight.
         if not problem.answered_correctly():
-            self._update_frequency(q, _FREQ_MAX)
+            new = self._update_frequency(q, _FREQ_MAX)
             self._error_count += 1
         else:
-            self._update_frequency(q, frequency(problem.answer_delay()))
+            new = self._update_frequency(q, frequency(problem.answer_delay()))
             self._correct_count += 1
+        self._unsaved_records.append((*q, new, problem.answered_correctly()))
+        self._unsaved_answers.append((*q, problem.answer_number(), problem.answered_correctly(),
+                                      problem.answer_delay(), time.time()))
 
     def save(self):
-        os.makedirs(_state_home, mode=0o700, exist_ok=True)
-        with open(_state_file, "wb") as state_file:
-            pickle.dump(self._frequency_map, state_file, protocol=-1)
-            pickle.dump(self._correct_count, state_file, protocol=-1)
-            pickle.dump(self._error_count, state_file, protocol=-1)
+        """Appends answers recorded since the last save to the journal.
+
+        The first save in a session, and every _JOURNAL_COMPACT_RECORDS
+        answers, the whole state is compacted into the state file instead.
+        """
+        self._submit(self._next_write())
+
+    def compact(self):
+        """Writes the whole state to the state file, starts an empty journal and closes it."""
+        self._submit(self._next_write(compact=True))
+        self.close()
+
+    def save_in_background(self, writer=None):
+        """Makes further writes happen on a separate thread, until close() is called.
+
+        The thread is that of the given BackgroundWriter, which may be shared
+        with other states, or a new one which is stopped on close().
+        """
+        self._owns_writer = writer is None
+        self._writer = writer or BackgroundWriter(self._write)
+        return self._writer
+
+    def close(self):
+        if self._writer is not None:
+            if self._owns_writer:
+                self._writer.stop()
+                logging.debug('Background writer coalesced %d writes.', self._writer.coalesced_count())
+            else:
+                self._writer.wait_for(self._write)
+            self._writer = None
+        self._storage.close()
+
+    def _submit(self, pending_write):
+        if self._writer is None:
+            self._write(pending_write)
+        else:
+            self._writer.submit(pending_write, self._write)
+
+    def _next_write(self, compact=False):
+        """Captures what needs to be written, so that it can be written on another thread."""
+        answers = list(self._unsaved_answers)
+        self._unsaved_answers.clear()
+        if compact or self._journal_records is None or self._journal_records >= _JOURNAL_COMPACT_RECORDS:
+            self._generation += 1
+            self._journal_records = 0
+            self._unsaved_records.clear()
+            snapshot = (array.array('d', self._frequencies), self._correct_count, self._error_count, self._generation,
+                        array.array('d', self._dues))
+            return PendingWrite(snapshot, [], answers)
+        records = list(self._unsaved_records)
+        self._journal_records += len(records)
+        self._unsaved_records.clear()
+        return PendingWrite(None, records, answers)
+
+    def _write(self, pending_write):
+        with _trace('write'):
+            self._storage.write(pending_write)
 
     def generate_problem(self, answer_count):
-        repetitions = (itertools.repeat(e[0], int(e[1])) for e in self._frequency_map.items() if e[0] != self._last_generated)
-        questions = list(i for i in (itertools.chain(*repetitions)))
-        generated = random.choice(questions)
-        self._last_generated = generated
-        return Problem(*generated, answer_count)
+        problem = self.prefetch_problem(answer_count)
+        self._prefetched = None
+        self._last_generated = problem._question()
+        return problem
+
+    def prefetch_problem(self, answer_count):
+        """Returns the problem which the next generate_problem call will return.
+
+        Like any problem, it is drawn excluding the last generated question.
+        Answering that question only changes the weight of that question, so
+        the prefetched problem stays valid, with the same probability as if it
+        was generated afterwards. Updating the weight of any other question
+        discards it.
+        """
+        if self._prefetched is None or len(self._prefetched.answers()) != answer_count:
+            excluded = None if self._last_generated is None else self._index(self._last_generated)
+            question = self._question(self._scheduler.pick(exclude=excluded))
+            with _trace('problem'):
+                self._prefetched = Problem(*question, answer_count, self._max_factor)
+        return self._prefetched
+
+    def generate_questions(self, count):
+        """Yields the given number of questions, like generate_problem but drawn in batches.
+
+        The state is not updated meanwhile, so the weights are the same for all questions.
+        """
+        excluded = None if self._last_generated is None else self._index(self._last_generated)
+        self._prefetched = None
+        for index in self._scheduler.pick_many(count, exclude=excluded):
+            self._last_generated = self._question(index)
+            yield self._last_generated
 
     def dump(self):
-        print('Frequency map:')
-        print('   |', *[('%4d ' % j) for j in _NUMBERS])
-        print('---+', '-'*60, sep='')
-        for i in _NUMBERS:
-            print('%2d |' % i, *[('%5.1f' % self._frequency_map[(i, j)]) for j in _NUMBERS])
-        print('Correct:', self._correct_count)
-        print('Errors:', self._error_count)
+        numbers = range(1, self._max_factor + 1)
+        label_width = max(2, len(str(self._max_factor)))
+        lines = [
+            'Frequency map:',
+            '%*s |' % (label_width, '') + ''.join(' %4d ' % j for j in numbers),
+            '-' * (label_width + 1) + '+' + '-' * (6 * len(numbers)),
+        ]
+        for i in numbers:
+            row_start = (i - 1) * self._size
+            row = self._frequencies[row_start:row_start + self._max_factor]
+            lines.append('%*d |' % (label_width, i) + ''.join(' %5.1f' % f for f in row))
+        lines.append('Correct: %d' % self._correct_count)
+        lines.append('Errors: %d' % self._error_count)
+        print('\n'.join(lines))
 
     def correct_count(self):
         return self._correct_count
@@ -271,6 +924,749 @@ class State:
         return self._error_count
 
 
+class PendingWrite:
+    """The whole state to write (if any), and answer records to write after that.
+
+    The whole state is a tuple of frequencies, correct count, error count,
+    generation and due times. Each record is a tuple of factors, new frequency and correctness.
+    Answers to append to the answer log are written regardless.
+    """
+
+    def __init__(self, snapshot, records, answers=None):
+        self.snapshot = snapshot
+        self.records = records
+        self.answers = answers or []
+
+    def followed_by(self, later):
+        """Returns a single write with the same effect as this one followed by the later one."""
+        answers = self.answers + later.answers
+        if later.snapshot is not None:
+            return PendingWrite(later.snapshot, later.records, answers)
+        return PendingWrite(self.snapshot, self.records + later.records, answers)
+
+
+class FileStorage:
+    """Keeps state in a state file, followed by a journal of later answers."""
+
+    def __init__(self, state_home=None):
+        self._state_home = state_home  # None means the default location.
+        self._journal = None
+        self._answer_log = AnswerLog(_answer_log_file if state_home is None
+                                     else os.path.join(state_home, _ANSWER_LOG_FILE_NAME))
+
+    def write(self, pending_write):
+        state_home, state_file_name, journal_file_name = _state_files(self._state_home)
+        if pending_write.snapshot is not None:
+            self.close()
+            os.makedirs(state_home, mode=0o700, exist_ok=True)
+            with _atomic_write(state_file_name) as state_file:
+                _write_state(state_file, *pending_write.snapshot)
+            with _atomic_write(journal_file_name) as journal_file:
+                journal_file.write(_JOURNAL_HEADER.pack(pending_write.snapshot[3]))
+        if pending_write.records:
+            if self._journal is None:
+                self._journal = open(journal_file_name, "ab")
+            self._journal.write(b''.join(_JOURNAL_RECORD.pack(*r) for r in pending_write.records))
+            self._journal.flush()
+        self._answer_log.append(pending_write.answers)
+
+    def close(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        self._answer_log.close()
+
+
+class BackgroundWriter:
+    """Performs writes on a dedicated thread.
+
+    Writes may go to several targets, each given by its write function, so
+    that one thread can save many states. Writes to a target submitted while
+    the thread is busy are coalesced into one.
+    """
+
+    def __init__(self, write=None):
+        self._write = write
+        self._pending = collections.OrderedDict()  # Write function -> pending write, in order of submission.
+        self._writing = None
+        self._stopping = False
+        self._coalesced_count = 0
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='tabliczka-writer', daemon=True)
+        self._thread.start()
+
+    def submit(self, pending_write, write=None):
+        write = write or self._write
+        with self._condition:
+            if write in self._pending:
+                pending_write = self._pending[write].followed_by(pending_write)
+                self._coalesced_count += 1
+            self._pending[write] = pending_write
+            self._condition.notify_all()
+
+    def coalesced_count(self):
+        return self._coalesced_count
+
+    def wait_for(self, write):
+        """Waits for outstanding writes with the given write function to finish."""
+        with self._condition:
+            while write in self._pending or self._writing == write:
+                self._condition.wait()
+
+    def stop(self):
+        """Waits for outstanding writes to finish and stops the thread."""
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._writing = None
+                self._condition.notify_all()
+                while not self._pending and not self._stopping:
+                    self._condition.wait()
+                if not self._pending:
+                    return
+                write, pending_write = self._pending.popitem(last=False)
+                self._writing = write
+            try:
+                write(pending_write)
+            except Exception as e:
+                logging.warning('Failed to save state: %s' % e)
+
+
+class ProfileStorage:
+    """Keeps state of a profile in the profile store."""
+
+    def __init__(self, store, name):
+        self._store = store
+        self._name = name
+        self._answer_log = AnswerLog(store.answer_log_file_name(name))
+
+    def write(self, pending_write):
+        self._store.write_state(self._name, pending_write)
+        self._answer_log.append(pending_write.answers)
+
+    def close(self):
+        self._answer_log.close()
+
+
+class ProfileStore:
+    """Keeps settings and state of many named profiles in an SQLite database.
+
+    The database is in WAL mode, so reading it (for example for a report)
+    does not block a session writing to it. All changes captured by a single
+    save are written in a single transaction.
+    """
+
+    def __init__(self, file_name, read_only=False):
+        """Opens the database, creating or upgrading it unless read_only is true.
+
+        A read-only store does not change the database in any way, so it can
+        be used to look at databases which may not be profile stores.
+        """
+        import sqlite3
+        self._file_name = file_name
+        if read_only:
+            self._db = sqlite3.connect('file:%s?mode=ro' % urllib.parse.quote(os.path.abspath(file_name)), uri=True)
+            return
+        os.makedirs(os.path.dirname(file_name), mode=0o700, exist_ok=True)
+        # Writes may happen on the background writer thread, one at a time.
+        self._db = sqlite3.connect(file_name, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        with self._db:
+            self._db.execute("""CREATE TABLE IF NOT EXISTS profiles (
+                name TEXT PRIMARY KEY,
+                settings TEXT,
+                correct_count INTEGER NOT NULL DEFAULT 0,
+                error_count INTEGER NOT NULL DEFAULT 0)""")
+            self._db.execute("""CREATE TABLE IF NOT EXISTS frequencies (
+                profile TEXT NOT NULL,
+                a INTEGER NOT NULL,
+                b INTEGER NOT NULL,
+                frequency REAL NOT NULL,
+                due REAL NOT NULL DEFAULT 0,
+                PRIMARY KEY (profile, a, b)) WITHOUT ROWID""")
+            if 'due' not in (row[1] for row in self._db.execute('PRAGMA table_info(frequencies)')):
+                self._db.execute('ALTER TABLE frequencies ADD COLUMN due REAL NOT NULL DEFAULT 0')
+
+    def close(self):
+        self._db.close()
+
+    def answer_log_file_name(self, name):
+        """Answer logs are not kept in the database, as they can grow large."""
+        return os.path.join(os.path.dirname(self._file_name), 'answers', urllib.parse.quote(name, safe='') + '.log')
+
+    def is_profile_store(self):
+        return self._db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'profiles'").fetchone() is not None
+
+    def profile_names(self):
+        return [row[0] for row in self._db.execute('SELECT name FROM profiles ORDER BY name')]
+
+    def read_settings(self, name):
+        row = self._db.execute('SELECT settings FROM profiles WHERE name = ?', (name,)).fetchone()
+        if row and row[0]:
+            return json.loads(row[0])
+
+    def write_settings(self, name, settings):
+        with self._db:
+            self._ensure_profile(name)
+            self._db.execute('UPDATE profiles SET settings = ? WHERE name = ?', (json.dumps(settings), name))
+
+    def read_state(self, name):
+        """Returns frequencies, correct count, error count and due times of the profile, or None if it has none."""
+        counts = self._db.execute('SELECT correct_count, error_count FROM profiles WHERE name = ?', (name,)).fetchone()
+        # Read-only stores may predate due times.
+        due = 'due' if any(row[1] == 'due' for row in self._db.execute('PRAGMA table_info(frequencies)')) else '0'
+        rows = self._db.execute('SELECT a, b, frequency, %s FROM frequencies WHERE profile = ?' % due, (name,)).fetchall()
+        if not rows:
+            return None
+        size = max(max(a, b) for a, b, _, _ in rows)
+        frequencies = array.array('d', [_FREQ_UNKNOWN]) * (size * size)
+        dues = array.array('d', [0.0]) * (size * size)
+        for a, b, f, due in rows:
+            frequencies[(a - 1) * size + (b - 1)] = f
+            dues[(a - 1) * size + (b - 1)] = due
+        return frequencies, counts[0], counts[1], dues
+
+    def write_state(self, name, pending_write):
+        with self._db:
+            self._ensure_profile(name)
+            if pending_write.snapshot is not None:
+                frequencies, correct_count, error_count, _, dues = pending_write.snapshot
+                size = math.isqrt(len(frequencies))
+                self._db.executemany(
+                        'INSERT OR REPLACE INTO frequencies (profile, a, b, frequency, due) VALUES (?, ?, ?, ?, ?)',
+                        ((name, i // size + 1, i % size + 1, f, due) for i, (f, due) in enumerate(zip(frequencies, dues))))
+                self._db.execute('UPDATE profiles SET correct_count = ?, error_count = ? WHERE name = ?',
+                        (correct_count, error_count, name))
+            if pending_write.records:
+                # Due times are not recorded, as they follow from the number of answers given before.
+                answer_count = sum(self._db.execute(
+                        'SELECT correct_count, error_count FROM profiles WHERE name = ?', (name,)).fetchone())
+                self._db.executemany(
+                        'INSERT OR REPLACE INTO frequencies (profile, a, b, frequency, due) VALUES (?, ?, ?, ?, ?)',
+                        ((name, a, b, f, answer_count + i + due_interval(f))
+                         for i, (a, b, f, _) in enumerate(pending_write.records)))
+                correct_count = sum(1 for r in pending_write.records if r[3])
+                self._db.execute(
+                        'UPDATE profiles SET correct_count = correct_count + ?, error_count = error_count + ? WHERE name = ?',
+                        (correct_count, len(pending_write.records) - correct_count, name))
+
+    def _ensure_profile(self, name):
+        self._db.execute('INSERT OR IGNORE INTO profiles (name) VALUES (?)', (name,))
+
+
+class AnswerLog:
+    """Appends answers to a log file, in blocks of columns."""
+
+    def __init__(self, file_name):
+        self._file_name = file_name
+        self._file = None
+
+    def append(self, answers):
+        if not answers:
+            return
+        if self._file is None:
+            os.makedirs(os.path.dirname(self._file_name), mode=0o700, exist_ok=True)
+            self._file = open(self._file_name, "ab")
+            if self._file.tell() == 0:
+                self._file.write(_ANSWER_LOG_HEADER.pack(_ANSWER_LOG_MAGIC, _ANSWER_LOG_VERSION))
+        block = [_ANSWER_LOG_BLOCK_HEADER.pack(len(answers))]
+        for i, (_, typecode) in enumerate(_ANSWER_LOG_COLUMNS):
+            column = array.array(typecode, (a[i] for a in answers))
+            if sys.byteorder == 'big':
+                column.byteswap()
+            block.append(column.tobytes())
+        self._file.write(b''.join(block))
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def read_answer_log(file_name):
+    """Yields blocks of the answer log, as dicts of column name to array of values."""
+    with open(file_name, "rb") as log_file:
+        header = log_file.read(_ANSWER_LOG_HEADER.size)
+        if len(header) < _ANSWER_LOG_HEADER.size:
+            return
+        magic, version = _ANSWER_LOG_HEADER.unpack(header)
+        if magic != _ANSWER_LOG_MAGIC or version != _ANSWER_LOG_VERSION:
+            raise ValueError('unsupported answer log format')
+        while True:
+            block_header = log_file.read(_ANSWER_LOG_BLOCK_HEADER.size)
+            if len(block_header) < _ANSWER_LOG_BLOCK_HEADER.size:
+                return
+            count, = _ANSWER_LOG_BLOCK_HEADER.unpack(block_header)
+            block = {}
+            for name, typecode in _ANSWER_LOG_COLUMNS:
+                column = array.array(typecode)
+                try:
+                    column.fromfile(log_file, count)
+                except EOFError:
+                    return  # A crash could have left an incomplete block at the end.
+                if sys.byteorder == 'big':
+                    column.byteswap()
+                block[name] = column
+            yield block
+
+
+class AnswerStats:
+    """Statistics of answers, gathered in memory which does not grow with the number of answers."""
+
+    def __init__(self):
+        self._questions = {}  # (a, b) -> [answers, correct answers, latency histogram]
+        self._days = {}  # date -> [answers, correct answers, total latency]
+
+    def add_block(self, block):
+        for a, b, correct, latency, timestamp in zip(
+                block['a'], block['b'], block['correct'], block['latency'], block['timestamp']):
+            question = self._questions.get((a, b))
+            if question is None:
+                question = self._questions[(a, b)] = [0, 0, array.array('I', [0]) * len(_LATENCY_BUCKETS)]
+            question[0] += 1
+            question[1] += correct
+            question[2][min(bisect.bisect_left(_LATENCY_BUCKETS, latency), len(_LATENCY_BUCKETS) - 1)] += 1
+            day = self._days.setdefault(datetime.date.fromtimestamp(timestamp), [0, 0, 0.0])
+            day[0] += 1
+            day[1] += correct
+            day[2] += latency
+
+    def lines(self):
+        yield 'Question  Answers  Correct  Latency p50  p90'
+        for (a, b), (count, correct, histogram) in sorted(self._questions.items()):
+            yield '%-8s  %7d  %6.1f%%  %10s  %4s' % (
+                    '%d*%d' % (a, b), count, 100 * correct / count,
+                    _histogram_percentile(histogram, count, 0.5), _histogram_percentile(histogram, count, 0.9))
+        yield ''
+        yield 'Day         Answers  Correct  Mean latency'
+        for day, (count, correct, total_latency) in sorted(self._days.items()):
+            yield '%s  %7d  %6.1f%%  %11.1fs' % (day.isoformat(), count, 100 * correct / count, total_latency / count)
+
+
+def _histogram_percentile(histogram, count, fraction):
+    """Returns the upper bound of the bucket holding the given percentile."""
+    seen = 0
+    for bucket, bucket_count in enumerate(histogram):
+        seen += bucket_count
+        if seen >= fraction * count:
+            break
+    if bucket == len(_LATENCY_BUCKETS) - 1:
+        return '>%.0fs' % _LATENCY_BUCKETS[-2]
+    return '%.1fs' % _LATENCY_BUCKETS[bucket]
+
+
+def print_stats(answer_log_file_name):
+    stats = AnswerStats()
+    try:
+        for block in read_answer_log(answer_log_file_name):
+            stats.add_block(block)
+    except FileNotFoundError:
+        print('No answers recorded yet.')
+        return
+    print('\n'.join(stats.lines()))
+
+
+def find_learners(dirs):
+    """Yields sources of state of all learners under the given directories.
+
+    Each source is a tuple of learner name and either a state directory,
+    or a profile store file name and profile name. Databases which are not
+    profile stores are skipped, and those which cannot be read are yielded
+    with no profile name, so that they are reported as failing to load.
+    """
+    for root in dirs:
+        for dir_path, dir_names, file_names in os.walk(root):
+            dir_names.sort()
+            name = os.path.relpath(dir_path, root)
+            name = os.path.basename(os.path.abspath(root)) if name == '.' else name
+            if _STATE_FILE_NAME in file_names or _LEGACY_STATE_FILE_NAME in file_names:
+                yield name, dir_path, None
+            for file_name in sorted(f for f in file_names if f.endswith('.sqlite')):
+                store_file_name = os.path.join(dir_path, file_name)
+                store_name = os.path.relpath(store_file_name, root)
+                try:
+                    profiles = _report_profile_names(store_file_name)
+                except Exception:
+                    # Let load_learner report the error, like for any other learner.
+                    yield store_name, store_file_name, None
+                    continue
+                for profile in profiles:
+                    yield '%s:%s' % (store_name, profile), store_file_name, profile
+
+
+def _report_profile_names(store_file_name):
+    """Returns names of profiles in the store, or none if the database is not a profile store."""
+    store = ProfileStore(store_file_name, read_only=True)
+    try:
+        return store.profile_names() if store.is_profile_store() else []
+    finally:
+        store.close()
+
+
+def load_learner(source):
+    """Returns the name, summary and frequency array of a learner, or the name and error."""
+    name, path, profile = source
+    try:
+        if profile is None and not os.path.isdir(path):
+            # A profile store whose profiles could not be listed; this raises the error again.
+            _report_profile_names(path)
+            raise ValueError('Profile store could not be read.')
+        if profile is None:
+            _, state_file, journal_file = _state_files(path)
+            if os.path.exists(state_file):
+                state = State.load_from(state_file, None, journal_file)
+            else:
+                state = State.load_legacy_from(os.path.join(path, _LEGACY_STATE_FILE_NAME))
+        else:
+            store = ProfileStore(path, read_only=True)
+            try:
+                state = State.load_profile(store, profile)
+            finally:
+                store.close()
+    except Exception as e:
+        return name, dict(error=str(e) or type(e).__name__), None
+    answered = [(state._question(i), f) for i, f in enumerate(state._frequencies) if f != _FREQ_UNKNOWN]
+    answer_count = state.correct_count() + state.error_count()
+    summary = dict(
+        table_size=state.max_factor(),
+        correct_count=state.correct_count(),
+        error_count=state.error_count(),
+        accuracy=state.correct_count() / answer_count if answer_count else None,
+        questions_answered=len(answered),
+        mean_frequency=sum(f for _, f in answered) / len(answered) if answered else None,
+        hardest_question=question_text(*max(answered, key=lambda qf: qf[1])[0]) if answered else None,
+        error=None)
+    return name, summary, state._frequencies
+
+
+def write_report(dirs, output_dir, report_format, workers=None):
+    """Writes a summary of each learner found, and mean frequency of each question across learners.
+
+    Learners are loaded in parallel. Those whose state cannot be loaded are
+    reported with the error.
+    """
+    import concurrent.futures
+    learners = []
+    totals = {}  # (a, b) -> [sum of frequencies, number of learners who answered]
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        for name, summary, frequencies in executor.map(load_learner, find_learners(dirs), chunksize=16):
+            learners.append(dict(name=name, **summary))
+            if frequencies is None:
+                logging.warning('Failed to load state of %s: %s', name, summary['error'])
+                continue
+            size = math.isqrt(len(frequencies))
+            for index, f in enumerate(frequencies):
+                if f != _FREQ_UNKNOWN:
+                    total = totals.setdefault((index // size + 1, index % size + 1), [0.0, 0])
+                    total[0] += f
+                    total[1] += 1
+    questions = [dict(a=a, b=b, learners=n, mean_frequency=total / n) for (a, b), (total, n) in sorted(totals.items())]
+    os.makedirs(output_dir, exist_ok=True)
+    if report_format == 'json':
+        with open(os.path.join(output_dir, 'report.json'), "w") as report_file:
+            json.dump(dict(learners=learners, questions=questions), report_file, indent=1)
+        return
+    import csv
+    with open(os.path.join(output_dir, 'learners.csv'), "w", newline='') as report_file:
+        writer = csv.DictWriter(report_file, ['name', 'table_size', 'correct_count', 'error_count', 'accuracy',
+                                              'questions_answered', 'mean_frequency', 'hardest_question', 'error'])
+        writer.writeheader()
+        writer.writerows(learners)
+    # A heatmap of mean frequencies, with a row for each a and a column for each b.
+    size = max((max(a, b) for a, b in totals), default=0)
+    with open(os.path.join(output_dir, 'questions.csv'), "w", newline='') as report_file:
+        writer = csv.writer(report_file)
+        writer.writerow(['a \\ b'] + list(range(1, size + 1)))
+        for a in range(1, size + 1):
+            writer.writerow([a] + ['%.1f' % (totals[(a, b)][0] / totals[(a, b)][1]) if (a, b) in totals else ''
+                                   for b in range(1, size + 1)])
+
+
+def _state_files(state_home):
+    """Returns the state directory, state file and journal file names."""
+    if state_home is None:
+        return _state_home, _state_file, _journal_file
+    return state_home, os.path.join(state_home, _STATE_FILE_NAME), os.path.join(state_home, _JOURNAL_FILE_NAME)
+
+
+def _read_state(state_file):
+    """Reads the state file, without creating an object per question.
+
+    Due times are None for files written before they were stored.
+    """
+    with mmap.mmap(state_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        magic, version, size, correct_count, error_count, generation = _STATE_HEADER.unpack_from(mapped)
+        if version not in (1, _STATE_VERSION):
+            raise ValueError('unsupported state file version %d' % version)
+        arrays = [array.array('d') for _ in range(1 if version == 1 else 2)]
+        start = _STATE_HEADER.size
+        for values in arrays:
+            end = start + size * size * values.itemsize
+            if len(mapped) < end:
+                raise ValueError('truncated state file')
+            with memoryview(mapped)[start:end] as value_bytes:
+                values.frombytes(value_bytes)
+            if sys.byteorder == 'big':
+                values.byteswap()
+            start = end
+    frequencies, dues = arrays if version > 1 else (arrays[0], None)
+    return frequencies, correct_count, error_count, generation, dues
+
+
+def _write_state(state_file, frequencies, correct_count, error_count, generation, dues):
+    size = math.isqrt(len(frequencies))
+    state_file.write(_STATE_HEADER.pack(_STATE_MAGIC, _STATE_VERSION, size, correct_count, error_count, generation))
+    for values in (frequencies, dues):
+        if sys.byteorder == 'big':
+            values = array.array('d', values)
+            values.byteswap()
+        values.tofile(state_file)
+
+
+class _LegacyUnpickler(pickle.Unpickler):
+    """Unpickles only built-in types, so that unpickling cannot run any code."""
+
+    def find_class(self, module, name):
+        raise pickle.UnpicklingError('%s.%s is not allowed in a state file' % (module, name))
+
+
+def _read_legacy_state(state_file):
+    """Reads a state file written by older versions, consisting of pickles.
+
+    The first is a dict of frequencies keyed by question, optionally followed
+    by the correct and error counts.
+    """
+    unpickler = _LegacyUnpickler(state_file)
+    frequency_map = unpickler.load()
+    if not isinstance(frequency_map, dict):
+        raise ValueError('Unexpected frequencies of type %s in legacy state file' % type(frequency_map).__name__)
+    try:
+        correct_count = unpickler.load()
+        error_count = unpickler.load()
+    except EOFError:
+        correct_count = 0
+        error_count = 0
+    return _frequencies_from_map(frequency_map), correct_count, error_count
+
+
+def _read_journal(journal_filename, generation):
+    """Returns journal records, unless the journal belongs to another generation of state."""
+    try:
+        with open(journal_filename, "rb") as journal_file:
+            journal = journal_file.read()
+    except FileNotFoundError:
+        return []
+    if len(journal) < _JOURNAL_HEADER.size or _JOURNAL_HEADER.unpack_from(journal)[0] != generation:
+        return []
+    records = memoryview(journal)[_JOURNAL_HEADER.size:]
+    # A crash could have left an incomplete record at the end.
+    records = records[:len(records) - len(records) % _JOURNAL_RECORD.size]
+    return list(_JOURNAL_RECORD.iter_unpack(records))
+
+
+@contextlib.contextmanager
+def _atomic_write(file_name):
+    temp_file_name = file_name + '.tmp'
+    with open(temp_file_name, "wb") as temp_file:
+        yield temp_file
+        temp_file.flush()
+        os.fsync(temp_file.fileno())
+    os.replace(temp_file_name, file_name)
+
+
+def _frequencies_from_map(frequency_map):
+    """Converts the (a, b)-keyed frequency dict of old state files to an array."""
+    size = max(max(q) for q in frequency_map)
+    frequencies = array.array('d', [_FREQ_UNKNOWN]) * (size * size)
+    for (a, b), f in frequency_map.items():
+        frequencies[(a - 1) * size + (b - 1)] = f
+    return frequencies
+
+
+def _resized_frequencies(frequencies, size, new_size, fill=_FREQ_UNKNOWN):
+    resized = array.array('d', [fill]) * (new_size * new_size)
+    for a in range(size):
+        resized[a * new_size:a * new_size + size] = frequencies[a * size:(a + 1) * size]
+    return resized
+
+
+class WeightedSampler:
+    """Picks indices with probability proportional to their weights.
+
+    Weights are kept in a Fenwick (binary indexed) tree, so both updating
+    a single weight and picking an index take O(log n) time.
+    """
+
+    def __init__(self, weights):
+        self._weights = array.array('d', weights)
+        self._size = len(self._weights)
+        self._tree = array.array('d', [0.0]) + self._weights
+        for i in range(1, self._size + 1):
+            parent = i + (i & -i)
+            if parent <= self._size:
+                self._tree[parent] += self._tree[i]
+        self._top_bit = 1 << (self._size.bit_length() - 1) if self._size else 0
+
+    def __len__(self):
+        return self._size
+
+    def weight(self, index):
+        return self._weights[index]
+
+    def total(self):
+        return self._prefix_sum(self._size)
+
+    def update(self, index, weight):
+        weight = float(weight)
+        delta = weight - self._weights[index]
+        self._weights[index] = weight
+        i = index + 1
+        while i <= self._size:
+            self._tree[i] += delta
+            i += i & -i
+
+    def pick(self, exclude=None):
+        """Returns a random index, never returning the one passed as exclude."""
+        if exclude is None:
+            return self._find(random.random() * self.total())
+        excluded_weight = self._weights[exclude]
+        excluded_start = self._prefix_sum(exclude)
+        while True:
+            target = random.random() * (self.total() - excluded_weight)
+            if target >= excluded_start:
+                target += excluded_weight
+            index = self._find(target)
+            if index != exclude:  # Can only happen due to rounding errors.
+                return index
+
+    def pick_many(self, count, exclude=None):
+        """Yields count random indices, never the same one twice in a row, nor the one passed as exclude.
+
+        Indices are drawn a batch at a time with a single cumulative weight
+        table, so weights must not be updated until the generator is done.
+        """
+        cumulative_weights = list(itertools.accumulate(self._weights))
+        indices = range(self._size)
+        while count > 0:
+            batch = random.choices(indices, cum_weights=cumulative_weights, k=min(count, _GENERATE_BATCH_SIZE))
+            for index in batch:
+                if index == exclude:
+                    index = self.pick(exclude=exclude)
+                exclude = index
+                yield index
+            count -= len(batch)
+
+    def _prefix_sum(self, end):
+        """Returns the sum of weights of indices lower than end."""
+        result = 0.0
+        while end > 0:
+            result += self._tree[end]
+            end -= end & -end
+        return result
+
+    def _find(self, target):
+        """Returns the lowest index for which the prefix sum including it exceeds target."""
+        position = 0
+        bit = self._top_bit
+        while bit:
+            candidate = position + bit
+            if candidate <= self._size and self._tree[candidate] <= target:
+                position = candidate
+                target -= self._tree[candidate]
+            bit >>= 1
+        return min(position, self._size - 1)
+
+
+class SamplingScheduler:
+    """Chooses questions at random, with probability proportional to their frequencies."""
+
+    def __init__(self, frequencies, dues):
+        self._sampler = WeightedSampler(frequencies)
+
+    def update(self, index, frequency, due):
+        self._sampler.update(index, frequency)
+
+    def pick(self, exclude=None):
+        return self._sampler.pick(exclude=exclude)
+
+    def pick_many(self, count, exclude=None):
+        return self._sampler.pick_many(count, exclude=exclude)
+
+
+class DueScheduler:
+    """Chooses the question which is due first, as in spaced repetition.
+
+    Questions with zero frequency are never chosen. The others are kept in
+    a heap ordered by due time. Updating a question pushes a new entry, and
+    leaves the old one in the heap until it reaches the top, so both
+    updating and picking take O(log n) amortized time. Questions due at the
+    same time are chosen in random order.
+    """
+
+    def __init__(self, frequencies, dues):
+        self._frequencies = array.array('d', frequencies)
+        self._entries = [None] * len(self._frequencies)  # The current heap entry of each question.
+        for index, (frequency, due) in enumerate(zip(self._frequencies, dues)):
+            if frequency:
+                self._entries[index] = (due, random.random(), index)
+        self._heap = [entry for entry in self._entries if entry is not None]
+        heapq.heapify(self._heap)
+
+    def update(self, index, frequency, due):
+        self._frequencies[index] = frequency
+        entry = self._entries[index] = (due, random.random(), index)
+        heapq.heappush(self._heap, entry)
+        if len(self._heap) > 2 * len(self._entries):
+            self._heap = [entry for entry in self._entries if entry is not None]
+            heapq.heapify(self._heap)
+
+    def pick(self, exclude=None):
+        """Returns the index due first, or the one due next if that one is passed as exclude."""
+        self._discard_stale()
+        first = self._heap[0]
+        if first[2] != exclude:
+            return first[2]
+        heapq.heappop(self._heap)
+        self._discard_stale()
+        index = self._heap[0][2] if self._heap else exclude
+        heapq.heappush(self._heap, first)
+        return index
+
+    def pick_many(self, count, exclude=None):
+        """Yields count indices, as if each was answered with unchanged frequency before the next one."""
+        heap = [entry for entry in self._entries if entry is not None]
+        heapq.heapify(heap)
+        clock = heap[0][0] if heap else 0
+        for _ in range(count):
+            entry = heapq.heappop(heap)
+            if entry[2] == exclude and heap:
+                entry = heapq.heapreplace(heap, entry)
+            due, _, index = entry
+            clock = max(clock, due)
+            heapq.heappush(heap, (clock + due_interval(self._frequencies[index]), random.random(), index))
+            clock += 1
+            exclude = index
+            yield index
+
+    def _discard_stale(self):
+        heap = self._heap
+        while heap and self._entries[heap[0][2]] is not heap[0]:
+            heapq.heappop(heap)
+
+
+_SCHEDULERS = {
+    'sampling': SamplingScheduler,
+    'due': DueScheduler,
+}
+
+
 class CLI:
     def __init__(self, settings):
         pass
@@ -282,9 +1678,14 @@ class CLI:
         pass
 
     def solve_problem(self, problem, state):
-        print("%s [%s]" % (problem, ", ".join(str(k) for k in problem.answers())))
+        print(problem_prompt(problem))
         asked_time = time.time()
-        problem.answered(input(), asked_time)
+        try:
+            with _trace('input'):
+                answer = input()
+        except EOFError:
+            raise QuitException()
+        problem.answered(answer, asked_time)
 
     def provide_feedback(self, problem, state):
         print(":-)" if problem.answered_correctly() else ":-(")
@@ -292,96 +1693,530 @@ class CLI:
     def answer_count(self):
         return 4
 
-class GUI:
-    _background_color = pygame.Color('white')
-    _text_color = pygame.Color('black')
-    _score_color = pygame.Color('gray')
-    _question_bg_color = pygame.Color('lightskyblue')
-    _answer_correct_color = pygame.Color('lightgreen')
-    _answer_error_color = pygame.Color(238, 144, 144, 255)
+
+class TUI:
+    """Asks questions in a terminal, laid out like in the GUI, and answered with a single key.
+
+    The screen is kept as a map of cells, each a text at a position, and
+    only the cells which differ from those already shown are redrawn.
+    """
 
     def __init__(self, settings):
+        import curses
+        self._answer_scheme = settings.answer_scheme
+        self._should_show_scores = settings.show_scores
+        self._should_show_feedback = settings.show_feedback
+        self._screen = None
+        self._cells = {}
+        self._correct_attr = self._error_attr = curses.A_REVERSE
+        self._keys = dict((ord(k), i) for i, k in enumerate(_KEYS_MINECRAFT_LOWER))
+        self._keys.update((ord(k), i) for i, k in enumerate(_KEYS_MINECRAFT_UPPER))
+        self._keys.update((k, i) for i, k in enumerate([curses.KEY_UP, curses.KEY_RIGHT, curses.KEY_DOWN, curses.KEY_LEFT]))
+
+    def __enter__(self):
+        import curses
+        screen = curses.initscr()
+        try:
+            curses.noecho()
+            curses.cbreak()
+            screen.keypad(True)
+            try:
+                curses.curs_set(0)
+            except curses.error:
+                pass
+            if curses.has_colors():
+                curses.start_color()
+                curses.init_pair(1, curses.COLOR_BLACK, curses.COLOR_GREEN)
+                curses.init_pair(2, curses.COLOR_BLACK, curses.COLOR_RED)
+                self._correct_attr = curses.color_pair(1)
+                self._error_attr = curses.color_pair(2)
+        except BaseException:
+            curses.endwin()
+            raise
+        self._screen = screen
+        return self
+
+    def __exit__(self, *exc):
+        import curses
+        self._screen.keypad(False)
+        curses.nocbreak()
+        curses.echo()
+        curses.endwin()
+
+    def answer_count(self):
+        return len(self._answer_scheme)
+
+    def solve_problem(self, problem, state):
+        answer_map = self._display_problem(problem, state)
+        # Time the answer from when the question is shown, like the GUI does, rather than from when typing starts.
+        asked_time = time.time()
+        with _trace('input'):
+            while True:
+                answer = self._read_answer(answer_map)
+                if answer is not None:
+                    problem.answered(answer, asked_time, time.time())
+                    return
+                if not self._cells:
+                    answer_map = self._display_problem(problem, state)
+
+    def provide_feedback(self, problem, state):
+        if not self._should_show_feedback:
+            return
+        answer_map = self._display_problem(problem, state, reveal_solution=True)
+        deadline = time.monotonic() + _ERROR_FEEDBACK_DELAY_MILLISEC / 1000
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                self._screen.timeout(int(1000 * remaining) + 1)
+                if self._read_answer(answer_map) is not None:
+                    logging.debug('Feedback dismissed.')
+                    return
+                if not self._cells:
+                    answer_map = self._display_problem(problem, state, reveal_solution=True)
+        finally:
+            self._screen.timeout(-1)
+
+    def _read_answer(self, answer_map):
+        """Waits for a key, and returns the answer it stands for, or None if it is not an answer key.
+
+        Also returns None on timeout. If the terminal has been resized, the screen
+        is cleared and forgotten, so that the caller draws everything again.
+        """
+        import curses
+        key = self._screen.getch()
+        if key in (ord('q'), ord('Q'), 27):
+            logging.debug('Initiating shutdown.')
+            raise QuitException()
+        if key == curses.KEY_RESIZE:
+            self._screen.clear()
+            self._cells.clear()
+        if key in self._keys:
+            return answer_map.answer_at(self._keys[key])
+        return None
+
+    def _display_problem(self, problem, state, reveal_solution=False):
+        import curses
+        height, width = self._screen.getmaxyx()
+        center_y, center_x = height // 2, width // 2
+        question = str(problem)
+        question_x = center_x - len(question) // 2
+        cells = {(center_y, question_x): (question, curses.A_BOLD)}
+        answers = list(problem.answers()) # copy before mutating the list
+        answer_map = AnswerMap()
+
+        def add_answer(y, x, answer):
+            attr = curses.A_NORMAL
+            if reveal_solution:
+                attr = self._correct_attr if answer == problem.correct_answer() else self._error_attr
+            cells[(y, max(0, x))] = (answer, attr)
+
+        if 'N' in self._answer_scheme:
+            answer_up = answers.pop(0)
+            add_answer(center_y - 2, center_x - len(answer_up) // 2, answer_up)
+            answer_map.answer_up(answer_up)
+
+        if 'E' in self._answer_scheme:
+            answer_right = answers.pop(0)
+            add_answer(center_y, question_x + len(question) + 4, answer_right)
+            answer_map.answer_right(answer_right)
+
+        if 'S' in self._answer_scheme:
+            answer_down = answers.pop(0)
+            add_answer(center_y + 2, center_x - len(answer_down) // 2, answer_down)
+            answer_map.answer_down(answer_down)
+
+        if 'W' in self._answer_scheme:
+            answer_left = answers.pop(0)
+            add_answer(center_y, question_x - 4 - len(answer_left), answer_left)
+            answer_map.answer_left(answer_left)
+
+        if self._should_show_scores:
+            correct_score = ':-) %d' % state.correct_count()
+            error_score = '%d :-(' % state.error_count()
+            cells[(height - 1, 0)] = (correct_score, curses.A_NORMAL)
+            # Writing to the bottom right corner fails, as it would scroll the screen.
+            cells[(height - 1, max(0, width - 1 - len(error_score)))] = (error_score, curses.A_NORMAL)
+
+        with _trace('render'):
+            self._update_cells(cells)
+        with _trace('flip'):
+            self._screen.refresh()
+        return answer_map
+
+    def _update_cells(self, cells):
+        """Blanks cells which are no longer shown, then draws those which are new or changed."""
+        import curses
+        for position, (text, attr) in self._cells.items():
+            if position not in cells or len(cells[position][0]) < len(text):
+                self._add_text(position, ' ' * len(text), curses.A_NORMAL)
+        for position, cell in cells.items():
+            if self._cells.get(position) != cell:
+                self._add_text(position, *cell)
+        self._cells = cells
+
+    def _add_text(self, position, text, attr):
+        import curses
+        try:
+            self._screen.addstr(position[0], position[1], text, attr)
+        except curses.error:
+            pass # does not fit in the terminal
+
+
+def problem_prompt(problem):
+    return "%s [%s]" % (problem, ", ".join(str(k) for k in problem.answers()))
+
+
+def write_worksheet(state, count, answer_count, output):
+    """Writes problems one per line as they are generated, so that any number of them fits in memory."""
+    for a, b in state.generate_questions(count):
+        output.write(problem_prompt(Problem(a, b, answer_count, state.max_factor())) + "\n")
+
+
+class Server:
+    """Serves many learners at once, over a line-based protocol on TCP.
+
+    After connecting, the client sends the learner's name on one line. Then
+    the server sends each problem the same way as the CLI does, and expects
+    the answer on one line. Wrong answers are followed by a ":-(" line.
+    States of learners are kept in memory until they have been idle for a while.
+    They are loaded on a worker thread and saved in the background, so that
+    slow disks do not hold up other learners.
+    """
+
+    def __init__(self, settings, idle_timeout=_SERVER_IDLE_TIMEOUT_SEC):
+        self._settings = settings
+        self._idle_timeout = idle_timeout
+        self._learners = {}
+        self._loading = {}  # Futures of states being loaded, by learner name.
+        self._compacting = {}  # Futures of states of evicted learners being written, by learner name.
+        self._writer = BackgroundWriter()  # Shared by all learners.
+
+    async def start(self, port):
+        import asyncio
+        return await asyncio.start_server(self._handle_connection, 'localhost', port, limit=_SERVER_LINE_LIMIT)
+
+    async def serve(self, port):
+        import asyncio
+        server = await self.start(port)
+        logging.info('Serving on %s.', ', '.join(str(s.getsockname()) for s in server.sockets))
+        evictor = asyncio.create_task(self._evict_idle_learners_periodically())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            evictor.cancel()
+            await self.close()
+
+    async def close(self):
+        import asyncio
+        learners, self._learners = self._learners, {}
+        await asyncio.gather(*(self._compact(name, learner.state) for name, learner in learners.items()))
+        await asyncio.get_running_loop().run_in_executor(None, self._writer.stop)
+        logging.debug('Background writer coalesced %d writes.', self._writer.coalesced_count())
+
+    def learner_count(self):
+        return len(self._learners)
+
+    async def evict_idle_learners(self, now):
+        import asyncio
+        idle = [(name, learner) for name, learner in self._learners.items()
+                if learner.connections == 0 and now - learner.last_active >= self._idle_timeout]
+        for name, _ in idle:
+            logging.debug('Evicting idle learner %s.', name)
+            del self._learners[name]
+        await asyncio.gather(*(self._compact(name, learner.state) for name, learner in idle))
+
+    async def _compact(self, name, state):
+        """Writes the whole state on a worker thread, as it waits for the write and syncs the disk."""
+        import asyncio
+        compacting = self._compacting[name] = asyncio.get_running_loop().run_in_executor(None, state.compact)
+        try:
+            await compacting
+        except Exception as e:
+            logging.warning('Failed to save state of %s: %s', name, e)
+        finally:
+            if self._compacting.get(name) is compacting:
+                del self._compacting[name]
+
+    async def _evict_idle_learners_periodically(self):
+        import asyncio
+        while True:
+            await asyncio.sleep(self._idle_timeout / 2)
+            await self.evict_idle_learners(time.monotonic())
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            writer.write(b'Name?\n')
+            name = (await reader.readline()).decode().strip()
+            if not _LEARNER_NAME.match(name):
+                writer.write(b'Invalid name.\n')
+                return
+            learner = self._learners.get(name)
+            if learner is None:
+                learner = await self._load_learner(name)
+            learner.connections += 1
+            try:
+                await self._run(learner, reader, writer)
+            finally:
+                learner.connections -= 1
+                learner.last_active = time.monotonic()
+        except (ConnectionError, UnicodeDecodeError, ValueError) as e:
+            # ValueError is raised by readline() on overly long lines.
+            logging.debug('Dropping connection: %s', e)
+        finally:
+            writer.close()
+
+    async def _load_learner(self, name):
+        import asyncio
+        compacting = self._compacting.get(name)
+        if compacting is not None:
+            # The learner came back while being evicted, so wait for the state to be written before reading it.
+            await asyncio.wait([compacting])
+        learner = self._learners.get(name)
+        if learner is not None:
+            return learner
+        # Connections for the same learner arriving during loading share it.
+        loading = self._loading.get(name)
+        if loading is None:
+            loading = self._loading[name] = asyncio.get_running_loop().run_in_executor(None, self._load_state, name)
+        try:
+            state = await loading
+        finally:
+            self._loading.pop(name, None)
+        learner = self._learners.get(name)
+        if learner is None:
+            learner = self._learners[name] = _ServedLearner(state)
+        return learner
+
+    def _load_state(self, name):
+        state = State.load(self._settings.max_factor, os.path.join(_state_home, 'learners', name), migrate=True)
+        state.use_scheduler(self._settings.scheduler)
+        state.save_in_background(self._writer)
+        return state
+
+    async def _run(self, learner, reader, writer):
+        state = learner.state
+        limit = self._settings.limit
+        while limit is None or limit > 0:
+            problem = state.generate_problem(4)
+            writer.write(problem_prompt(problem).encode() + b'\n')
+            await writer.drain()
+            asked_time = time.time()
+            answer = await reader.readline()
+            if not answer:
+                return
+            problem.answered(answer.decode(), asked_time)
+            learner.last_active = time.monotonic()
+            state.update_from(problem)
+            if not problem.answered_correctly():
+                writer.write(b':-(\n')
+            elif limit is not None:
+                limit -= 1
+            state.save()
+
+
+class _ServedLearner:
+
+    def __init__(self, state):
+        self.state = state
+        self.connections = 0
+        self.last_active = time.monotonic()
+
+
+class GUI:
+    # Plain tuples rather than pygame.Color, so that pygame is only imported when the GUI is used.
+    _background_color = (255, 255, 255, 255)  # white
+    _text_color = (0, 0, 0, 255)  # black
+    _score_color = (190, 190, 190, 255)  # gray
+    _question_bg_color = (135, 206, 250, 255)  # lightskyblue
+    _answer_correct_color = (144, 238, 144, 255)  # lightgreen
+    _answer_error_color = (238, 144, 144, 255)
+
+    def __init__(self, settings, session=None):
+        self._session = session  # A SessionRecorder or SessionReplayer, if any.
         self._font_size = 80
         self._score_font_size = 50
         self._should_show_scores = settings.show_scores
         self._should_show_feedback = settings.show_feedback
         self._score_font_name = settings.score_font
         self._answer_scheme = settings.answer_scheme
+        self._max_factor = settings.max_factor
+        self._should_prerender = settings.prerender
+        self._should_prefetch = settings.prefetch
+        self._prepared = None  # The prefetched problem, with its frame and answer map.
+        self._text_cache = TextCache(_TEXT_CACHE_SIZE)
 
     def __enter__(self):
+        import pygame
         logging.debug('Initializing pygame.')
         pygame.init()
+        fonts_start = time.perf_counter()
+        font_cache = FontCache(_font_cache_filename)
         logging.debug('Preparing main font.')
-        self._font = pygame.font.SysFont("monospace", self._font_size)
+        self._font = font_cache.font("monospace", self._font_size)
         if self._should_show_scores:
             logging.debug('Preparing score font "%s".', self._score_font_name)
-            self._score_font = pygame.font.SysFont(self._score_font_name, self._score_font_size)
+            self._score_font = font_cache.font(self._score_font_name, self._score_font_size)
+        font_cache.save()
+        fonts_msec = 1000 * (time.perf_counter() - fonts_start)
+        if font_cache.scanned():
+            logging.debug('Prepared fonts in %.1f msec, scanning installed fonts.', fonts_msec)
+        else:
+            logging.debug('Prepared fonts in %.1f msec from cache, instead of %.1f msec scanning installed fonts.',
+                    fonts_msec, font_cache.scan_msec())
         self._digit_size = self._font.size('J')
-        self._screen_size = (self._font.size(' 100  10 * 10 = ?  100 ')[0], self._digit_size[1] * 7)
+        widest_answer = str(self._max_factor * self._max_factor)
+        widest_line = ' %s  %d * %d = ?  %s ' % (widest_answer, self._max_factor, self._max_factor, widest_answer)
+        self._answer_left_column = (len(widest_answer) + 3) // 2
+        self._answer_right_column = len(widest_line) - (len(widest_answer) + 1) // 2
+        self._screen_size = (self._font.size(widest_line)[0], self._digit_size[1] * 7)
         logging.debug('Setting display mode.')
         self._screen = pygame.display.set_mode(self._screen_size)
-        self._clock = pygame.time.Clock()
+        if self._should_show_scores:
+            logging.debug('Loading images.')
+            data.preload()
+        if self._should_prerender:
+            logging.debug('Prerendering texts.')
+            self._prerender()
+        # Only wake up for events which are acted upon.
+        self._feedback_timeout_event = pygame.USEREVENT
+        pygame.event.set_blocked(None)
+        pygame.event.set_allowed([pygame.QUIT, pygame.KEYDOWN, self._feedback_timeout_event])
+        self._waiting_wall_time = 0
+        self._waiting_cpu_time = 0
+        self.frame_count = 0
+        self.display_sec = 0
         logging.debug('Enabling display.')
         pygame.display.flip()
         logging.debug('GUI setup complete.')
         return self
 
     def __exit__(self, *exc):
+        import pygame
+        logging.debug('Text cache hit rate: %.1f%%.', 100 * self._text_cache.hit_rate())
+        if self._waiting_wall_time:
+            logging.debug('Used %.3f sec of CPU per minute of waiting for input.', self.waiting_cpu_sec_per_minute())
+        if self.frame_count:
+            logging.debug('Displayed %d frames, %.2f msec each on average.',
+                    self.frame_count, 1000 * self.display_sec / self.frame_count)
         logging.debug('Quitting pygame.')
         pygame.quit()
         logging.debug('GUI teardown complete.')
 
-    def _tick(self):
-        self._clock.tick(30) # low framerate is fine for this app
+    def waiting_cpu_sec_per_minute(self):
+        """Returns seconds of CPU time used per minute spent waiting for input, so far."""
+        return 60 * self._waiting_cpu_time / self._waiting_wall_time if self._waiting_wall_time else 0
+
+    def _wait_for_event(self):
+        import pygame
+        wall_start = time.monotonic()
+        cpu_start = time.process_time()
+        with _trace('input'):
+            event = self._session.wait_for_event(pygame.event.wait) if self._session else pygame.event.wait()
+        self._waiting_wall_time += time.monotonic() - wall_start
+        self._waiting_cpu_time += time.process_time() - cpu_start
+        logging.debug('Processing event %s.', event)
+        return event
+
+    def _now(self):
+        return self._session.now() if self._session else time.time()
+
+    def _prerender(self):
+        """Renders every product, and every question too if they all fit in the text cache."""
+        numbers = range(1, self._max_factor + 1)
+        texts = [str(p) for p in sorted(set(a * b for a, b in itertools.product(numbers, numbers)))]
+        questions = [question_text(a, b) for a, b in itertools.product(numbers, numbers)]
+        if len(texts) + len(questions) <= _TEXT_CACHE_SIZE:
+            texts += questions
+        else:
+            logging.debug('Table too large to prerender questions, prerendering %d of %d products.',
+                    min(len(texts), _TEXT_CACHE_SIZE), len(texts))
+            texts = texts[:_TEXT_CACHE_SIZE]
+        for text in texts:
+            self._text_cache.render(self._font, text, self._text_color)
+        self._text_cache.reset_counters()
 
     def answer_count(self):
         return len(self._answer_scheme)
 
     def solve_problem(self, problem, state):
+        import pygame
         answer_map = self._display_problem(problem, state)
-
-        asked_time = time.time()
+        # Time the answer from when the question is shown, as it can be read while the next one is prepared.
+        asked_time = self._now()
+        if self._should_prefetch:
+            self._prepare(state.prefetch_problem(self.answer_count()))
 
         while True:
-            self._tick()
-            for event in pygame.event.get():
-                logging.debug('Processing event %s.', event)
-                if event.type == pygame.QUIT:
-                    logging.debug('Initiating shutdown.')
-                    raise QuitException()
-                if event.type == pygame.KEYDOWN:
-                    logging.debug(answer_map)
-                    if answer_map.has_answer_for(event):
-                        problem.answered(answer_map.answer_for(event), asked_time)
-                        return
-                    else:
-                        continue
+            event = self._wait_for_event()
+            if event.type == pygame.QUIT:
+                logging.debug('Initiating shutdown.')
+                raise QuitException()
+            if event.type == pygame.KEYDOWN:
+                logging.debug(answer_map)
+                if answer_map.has_answer_for(event):
+                    problem.answered(answer_map.answer_for(event), asked_time, self._now())
+                    return
 
     def provide_feedback(self, problem, state):
+        import pygame
         if not self._should_show_feedback:
             return
-        self._display_problem(problem, state, reveal_solution=True)
-        wait_start = pygame.time.get_ticks()
-        wait_end = wait_start + _ERROR_FEEDBACK_DELAY_MILLISEC
-
-        while pygame.time.get_ticks() < wait_end:
-            self._tick()
-            for event in pygame.event.get():
+        answer_map = self._display_problem(problem, state, reveal_solution=True)
+        pygame.time.set_timer(self._feedback_timeout_event, _ERROR_FEEDBACK_DELAY_MILLISEC)
+        try:
+            # The answer has already been taken into account, so the next problem can be prepared meanwhile.
+            self._prepare(state.prefetch_problem(self.answer_count()))
+            while True:
+                event = self._wait_for_event()
                 if event.type == pygame.QUIT:
                     raise QuitException()
-                # Ignore any other event
+                if event.type == self._feedback_timeout_event:
+                    return
+                if event.type == pygame.KEYDOWN and answer_map.has_answer_for(event):
+                    logging.debug('Feedback dismissed.')
+                    return
+        finally:
+            pygame.time.set_timer(self._feedback_timeout_event, 0)
+            pygame.event.clear(self._feedback_timeout_event)
+
+    def _prepare(self, problem):
+        """Draws the problem off screen, for _display_problem to show it with a single blit."""
+        import pygame
+        if self._prepared is not None and self._prepared[0] is problem:
+            return
+        logging.debug('Preparing next problem.')
+        frame = pygame.Surface(self._screen_size)
+        answer_map = self._draw_problem(frame, problem)
+        self._prepared = (problem, frame, answer_map)
+
+    def _draw_problem(self, surface, problem, reveal_solution=False):
+        with _trace('render'):
+            surface.fill(self._background_color)
+            self._show_question(surface, problem)
+            return self._show_answers(surface, problem, problem.answers(), reveal_solution=reveal_solution)
 
     def _display_problem(self, problem, state, reveal_solution=False):
+        import pygame
         logging.debug('Displaying %s.' % ('solution' if reveal_solution else 'problem'))
-        self._screen.fill(self._background_color)
+        display_start = time.perf_counter()
+        if not reveal_solution and self._prepared is not None and self._prepared[0] is problem:
+            _, frame, answer_map = self._prepared
+            self._screen.blit(frame, (0, 0))
+            self._prepared = None
+        else:
+            answer_map = self._draw_problem(self._screen, problem, reveal_solution)
         if self._should_show_scores:
             self._show_correct_score(state)
             self._show_error_score(state)
-        self._show_question(problem)
-        answer_map = self._show_answers(problem, problem.answers(), reveal_solution=reveal_solution)
         logging.debug('Updating display.')
-        pygame.display.flip()
-        logging.debug('Problem displayed.')
+        with _trace('flip'):
+            pygame.display.flip()
+        self.frame_count += 1
+        self.display_sec += time.perf_counter() - display_start
+        logging.debug('Problem displayed, text cache hit rate %.1f%%.', 100 * self._text_cache.hit_rate())
         return answer_map
 
     def _show_correct_score(self, state):
@@ -391,7 +2226,7 @@ class GUI:
         correct_image_rect = correct_image.get_rect(bottomleft=screen_bottom_left)
         self._screen.blit(correct_image, correct_image_rect)
 
-        correct_score = self._score_font.render(' %4d' % state.correct_count(), 1, self._score_color)
+        correct_score = self._text_cache.render(self._score_font, ' %4d' % state.correct_count(), self._score_color)
         correct_score_rect = correct_score.get_rect(midleft=correct_image_rect.midright)
         self._screen.blit(correct_score, correct_score_rect)
 
@@ -402,52 +2237,54 @@ class GUI:
         error_image_rect = error_image.get_rect(bottomright=screen_bottom_right)
         self._screen.blit(error_image, error_image_rect)
 
-        error_score = self._score_font.render('%4d ' % state.error_count(), 1, self._score_color)
+        error_score = self._text_cache.render(self._score_font, '%4d ' % state.error_count(), self._score_color)
         error_score_rect = error_score.get_rect(midright=error_image_rect.midleft)
         self._screen.blit(error_score, error_score_rect)
 
-    def _show_question(self, problem):
-        screen_center = self._screen.get_rect().center
-        question = self._font.render(str(problem), 1, self._text_color)
+    def _show_question(self, surface, problem):
+        import pygame
+        screen_center = surface.get_rect().center
+        question = self._text_cache.render(self._font, str(problem), self._text_color)
         question_rect = question.get_rect(center=screen_center)
-        pygame.draw.rect(self._screen, self._question_bg_color, question_rect)
-        self._screen.blit(question, question_rect)
+        pygame.draw.rect(surface, self._question_bg_color, question_rect)
+        surface.blit(question, question_rect)
 
-    def _show_answers(self, problem, answers, reveal_solution=False):
-        screen_center = self._screen.get_rect().center
+    def _show_answers(self, surface, problem, answers, reveal_solution=False):
+        import pygame
+        screen_center = surface.get_rect().center
         answers = list(answers) # copy before mutating the list
         answer_map = AnswerMap()
 
         if 'N' in self._answer_scheme:
             answer_up = answers.pop(0)
-            answer_up_surface = self._font.render(answer_up, 1, self._text_color)
+            answer_up_surface = self._text_cache.render(self._font, answer_up, self._text_color)
             answer_up_rect = answer_up_surface.get_rect(center=(screen_center[0], int(1.5*self._digit_size[1])))
-            pygame.draw.rect(self._screen, self._answer_color(problem, answer_up, reveal_solution), answer_up_rect)
-            self._screen.blit(answer_up_surface, answer_up_rect)
+            pygame.draw.rect(surface, self._answer_color(problem, answer_up, reveal_solution), answer_up_rect)
+            surface.blit(answer_up_surface, answer_up_rect)
             answer_map.answer_up(answer_up)
 
         if 'E' in self._answer_scheme:
             answer_right = answers.pop(0)
-            answer_right_surface = self._font.render(answer_right, 1, self._text_color)
-            answer_right_rect = answer_right_surface.get_rect(center=(int(21*self._digit_size[0]), screen_center[1]))
-            pygame.draw.rect(self._screen, self._answer_color(problem, answer_right, reveal_solution), answer_right_rect)
-            self._screen.blit(answer_right_surface, answer_right_rect)
+            answer_right_surface = self._text_cache.render(self._font, answer_right, self._text_color)
+            answer_right_rect = answer_right_surface.get_rect(center=(int(self._answer_right_column*self._digit_size[0]), screen_center[1]))
+            pygame.draw.rect(surface, self._answer_color(problem, answer_right, reveal_solution), answer_right_rect)
+            surface.blit(answer_right_surface, answer_right_rect)
             answer_map.answer_right(answer_right)
 
         if 'S' in self._answer_scheme:
             answer_down = answers.pop(0)
-            answer_down_surface = self._font.render(answer_down, 1, self._text_color)
+            answer_down_surface = self._text_cache.render(self._font, answer_down, self._text_color)
             answer_down_rect = answer_down_surface.get_rect(center=(screen_center[0], int(5.5*self._digit_size[1])))
-            pygame.draw.rect(self._screen, self._answer_color(problem, answer_down, reveal_solution), answer_down_rect)
-            self._screen.blit(answer_down_surface, answer_down_rect)
+            pygame.draw.rect(surface, self._answer_color(problem, answer_down, reveal_solution), answer_down_rect)
+            surface.blit(answer_down_surface, answer_down_rect)
             answer_map.answer_down(answer_down)
 
         if 'W' in self._answer_scheme:
             answer_left = answers.pop(0)
-            answer_left_surface = self._font.render(answer_left, 1, self._text_color)
-            answer_left_rect = answer_left_surface.get_rect(center=(int(3*self._digit_size[0]), screen_center[1]))
-            pygame.draw.rect(self._screen, self._answer_color(problem, answer_left, reveal_solution), answer_left_rect)
-            self._screen.blit(answer_left_surface, answer_left_rect)
+            answer_left_surface = self._text_cache.render(self._font, answer_left, self._text_color)
+            answer_left_rect = answer_left_surface.get_rect(center=(int(self._answer_left_column*self._digit_size[0]), screen_center[1]))
+            pygame.draw.rect(surface, self._answer_color(problem, answer_left, reveal_solution), answer_left_rect)
+            surface.blit(answer_left_surface, answer_left_rect)
             answer_map.answer_left(answer_left)
 
         return answer_map
@@ -459,6 +2296,204 @@ class GUI:
         return self._answer_correct_color if problem.correct_answer() == answer else self._answer_error_color
 
 
+class FontCache:
+    """Remembers files of fonts found by name, as finding them means scanning all installed fonts.
+
+    The cache is ignored once fonts are installed or removed, as far as can
+    be told from modification times of font directories.
+    """
+
+    def __init__(self, file_name):
+        self._file_name = file_name
+        self._fingerprint = _font_fingerprint()
+        self._paths = {}
+        self._scan_msec = 0.0
+        self._scanned = False
+        try:
+            with open(file_name) as cache_file:
+                cached = json.load(cache_file)
+            if cached['fingerprint'] == self._fingerprint:
+                self._paths = cached['paths']
+                self._scan_msec = cached['scan_msec']
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.debug('Not using font cache: %s', e)
+
+    def font(self, name, size):
+        import pygame
+        path = self._paths.get(name, '')
+        if path == '' or (path is not None and not os.path.exists(path)):
+            scan_start = time.perf_counter()
+            path = self._paths[name] = pygame.font.match_font(name)  # None stands for the default font.
+            self._scan_msec += 1000 * (time.perf_counter() - scan_start)
+            self._scanned = True
+        return pygame.font.Font(path, size)
+
+    def scanned(self):
+        return self._scanned
+
+    def scan_msec(self):
+        return self._scan_msec
+
+    def save(self):
+        if not self._scanned:
+            return
+        try:
+            os.makedirs(os.path.dirname(self._file_name), mode=0o700, exist_ok=True)
+            with _atomic_write(self._file_name) as cache_file:
+                cache_file.write(json.dumps(dict(
+                    fingerprint=self._fingerprint, paths=self._paths, scan_msec=self._scan_msec)).encode())
+        except OSError as e:
+            logging.warning('Failed to save font cache: %s', e)
+
+
+def _font_fingerprint():
+    import pygame
+    fingerprint = [pygame.version.ver]
+    for font_dir in _FONT_DIRS:
+        try:
+            fingerprint.append([font_dir, os.stat(font_dir).st_mtime_ns])
+        except OSError:
+            pass
+    return fingerprint
+
+
+class SessionRecorder:
+    """Records everything a GUI session depends on, so that it can be replayed.
+
+    That is the settings, the state at the start, the random seed, input
+    events and clock readings. The state at the end is recorded too, to
+    check that replaying gets to the same state.
+    """
+
+    def __init__(self, settings, state, seed):
+        self._recording = dict(version=1, seed=seed, settings=settings.to_dict(),
+                               initial_state=_state_to_dict(state), events=[], clock=[])
+
+    def now(self):
+        now = time.time()
+        self._recording['clock'].append(now)
+        return now
+
+    def wait_for_event(self, wait):
+        event = wait()
+        self._recording['events'].append([event.type, getattr(event, 'key', None), getattr(event, 'unicode', None)])
+        return event
+
+    def write(self, file_name, state):
+        self._recording['final_state'] = _state_to_dict(state)
+        with open(file_name, "w") as recording_file:
+            json.dump(self._recording, recording_file)
+
+
+class SessionReplayer:
+    """Feeds recorded input events and clock readings back to a GUI session."""
+
+    def __init__(self, recording):
+        self._events = iter(recording['events'])
+        self._clock = iter(recording['clock'])
+
+    def now(self):
+        return next(self._clock)
+
+    def wait_for_event(self, wait):
+        import pygame
+        try:
+            event_type, key, unicode = next(self._events)
+        except StopIteration:
+            raise QuitException()
+        attributes = dict(key=key, unicode=unicode) if key is not None else {}
+        return pygame.event.Event(event_type, **attributes)
+
+
+class DiscardingStorage:
+    """Drops all writes, for replaying sessions."""
+
+    def write(self, pending_write):
+        pass
+
+    def close(self):
+        pass
+
+
+def _state_to_dict(state):
+    return dict(frequencies=list(state._frequencies), dues=list(state._dues), max_factor=state.max_factor(),
+                correct_count=state.correct_count(), error_count=state.error_count())
+
+
+def record_session(settings, state, file_name):
+    seed = random.randrange(2**32)
+    random.seed(seed)
+    recorder = SessionRecorder(settings, state, seed)
+    # Replaying starts with a scheduler built from scratch, and rounding may differ after updates.
+    state._scheduler = state._new_scheduler()
+    with GUI(settings, recorder) as ui:
+        try:
+            run(ui, settings, state)
+        except QuitException:
+            pass
+    recorder.write(file_name, state)
+
+
+def replay_session(file_name):
+    """Replays a recorded GUI session with the dummy video driver, as fast as possible.
+
+    Returns whether it ended in the recorded state, the number of frames
+    displayed, and the total time spent displaying them.
+    """
+    with open(file_name) as recording_file:
+        recording = json.load(recording_file)
+    os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    random.seed(recording['seed'])
+    settings = Settings(MemoryFS(recording['settings']), get_argument_parser().parse_args([]))
+    initial = recording['initial_state']
+    state = State(array.array('d', initial['frequencies']), initial['correct_count'], initial['error_count'],
+                  initial['max_factor'], dues=array.array('d', initial['dues']))
+    state._storage = DiscardingStorage()
+    with GUI(settings, SessionReplayer(recording)) as ui:
+        try:
+            run(ui, settings, state)
+        except QuitException:
+            pass
+    return _state_to_dict(state) == recording['final_state'], ui.frame_count, ui.display_sec
+
+
+def _keys_arrows():
+    import pygame
+    return (pygame.K_UP, pygame.K_RIGHT, pygame.K_DOWN, pygame.K_LEFT)
+
+
+class TextCache:
+    """A bounded cache of rendered text surfaces, evicting least recently used ones."""
+
+    def __init__(self, max_size):
+        self._max_size = max_size
+        self._surfaces = collections.OrderedDict()
+        self._hits = 0
+        self._misses = 0
+
+    def render(self, font, text, color):
+        key = (font, text, color)
+        surface = self._surfaces.get(key)
+        if surface is not None:
+            self._hits += 1
+            self._surfaces.move_to_end(key)
+            return surface
+        self._misses += 1
+        surface = font.render(text, 1, color)
+        self._surfaces[key] = surface
+        if len(self._surfaces) > self._max_size:
+            self._surfaces.popitem(last=False)
+        return surface
+
+    def reset_counters(self):
+        self._hits = 0
+        self._misses = 0
+
+    def hit_rate(self):
+        lookups = self._hits + self._misses
+        return self._hits / lookups if lookups else 0
+
+
 class AnswerMap:
 
     def __init__(self):
@@ -488,25 +2523,30 @@ class AnswerMap:
             answer_index = _KEYS_MINECRAFT_LOWER.index(event.unicode)
         elif event.unicode and event.unicode in _KEYS_MINECRAFT_UPPER:
             answer_index = _KEYS_MINECRAFT_UPPER.index(event.unicode)
-        elif event.key and event.key in _KEYS_ARROWS:
-            answer_index = _KEYS_ARROWS.index(event.key)
+        elif event.key and event.key in _keys_arrows():
+            answer_index = _keys_arrows().index(event.key)
         else:
             return None
+        return self.answer_at(answer_index)
+
+    def answer_at(self, answer_index):
+        """Returns the answer for the key at the given index of the key sequences, clockwise from up."""
         direction = ['up', 'right', 'down', 'left'][answer_index]
         return self._answers[direction]
 
 
 class Problem:
 
-    def __init__(self, a, b, answer_count):
+    def __init__(self, a, b, answer_count, max_factor=_DEFAULT_MAX_FACTOR):
         self._a = a
         self._b = b
+        self._max_factor = max_factor
         wrong_answer_count = answer_count - 1
-        self._answers = list(random.sample(sorted(self.wrong_answers()), wrong_answer_count)) + [self.correct_answer()]
+        self._answers = random.sample(self.wrong_answers(wrong_answer_count), wrong_answer_count) + [self.correct_answer()]
         random.shuffle(self._answers)
 
     def __str__(self):
-        return "%(a)s * %(b)s = ?" % dict(a=self._a, b=self._b)
+        return question_text(self._a, self._b)
 
     def _question(self):
         return (self._a, self._b)
@@ -517,49 +2557,72 @@ class Problem:
     def answers(self):
         return self._answers
 
-    def wrong_answers(self):
-        # TODO: also generate correct_answer+1, +2, -1, -2, ...
-        closest_as = closest_ns(self._a)
-        closest_bs = closest_ns(self._b)
-        closest_problems = dict((str(p[0]*p[1]), p) for p in itertools.product(closest_as, closest_bs))
-        del closest_problems[self.correct_answer()]
-        if len(closest_problems) >= 3:
-            return closest_problems
-        close_as = close_ns(self._a)
-        close_bs = close_ns(self._b)
-        close_problems = dict((str(p[0]*p[1]), p) for p in itertools.product(close_as, close_bs))
-        del close_problems[self.correct_answer()]
-        return close_problems
-
-    def answered(self, answer_text, asked_time):
+    def wrong_answers(self, count=_WRONG_ANSWER_COUNT):
+        return wrong_answers(self._a, self._b, self._max_factor, max(count, _WRONG_ANSWER_COUNT))
+
+    def answered(self, answer_text, asked_time, answered_time=None):
         self._answer_text = answer_text.strip()
-        self._answer_delay = time.time() - asked_time
+        self._answer_delay = (time.time() if answered_time is None else answered_time) - asked_time
 
     def answer_delay(self):
         return self._answer_delay
 
+    def answer_number(self):
+        """Returns the chosen answer as a number, or -1 if it is not a number that fits in the answer log."""
+        try:
+            number = int(self._answer_text)
+        except ValueError:
+            return -1
+        return number if 0 <= number <= _ANSWER_LOG_ANSWER_MAX else -1
+
     def answered_correctly(self):
         return self._answer_text == self.correct_answer()
 
 
-def closest_ns(n):
-    if n == 1:
-        return 1, 2
-    elif n == 10:
-        return 9, 10
-    else:
-        return n-1, n, n+1
+def question_text(a, b):
+    return "%(a)s * %(b)s = ?" % dict(a=a, b=b)
 
 
-def close_ns(n):
-    if n == 1 or n == 2:
-        return 1, 2, 3, 4
-    elif n == 9 or n == 10:
-        return 7, 8, 9, 10
-    else:
-        return n-2, n-1, n, n+1, n+2
+@functools.lru_cache(maxsize=None)
+def wrong_answers(a, b, max_factor, count):
+    """Returns a sorted tuple of at least count plausible wrong answers to a * b.
+
+    These are products of factors close to a and b, to make it necessary to
+    actually know the answer. If there are too few of these, numbers close to
+    the correct answer are added.
+    """
+    correct = a * b
+    answers = set(p[0]*p[1] for p in itertools.product(closest_ns(a, max_factor), closest_ns(b, max_factor)))
+    answers.discard(correct)
+    if len(answers) < count:
+        answers.update(p[0]*p[1] for p in itertools.product(close_ns(a, max_factor), close_ns(b, max_factor)))
+        answers.discard(correct)
+    offset = 1
+    while len(answers) < count:
+        answers.add(correct + offset)
+        if correct - offset > 0:
+            answers.add(correct - offset)
+        offset += 1
+    return tuple(sorted(str(n) for n in answers))
 
 
+def closest_ns(n, max_n=_DEFAULT_MAX_FACTOR):
+    return tuple(range(max(1, n-1), min(max_n, n+1) + 1))
+
+
+def close_ns(n, max_n=_DEFAULT_MAX_FACTOR):
+    if n <= 2:
+        ns = 1, 2, 3, 4
+    elif n >= max_n - 1:
+        ns = max_n-3, max_n-2, max_n-1, max_n
+    else:
+        ns = n-2, n-1, n, n+1, n+2
+    return tuple(i for i in ns if 1 <= i <= max_n)
+
 
 if __name__ == '__main__':
+    if getattr(sys, 'frozen', False):
+        # Worker processes of a frozen executable (for --report) run it again, and must not start the program.
+        import multiprocessing
+        multiprocessing.freeze_support()
     main()
@@ -0,0 +1,269 @@
+#!/usr/bin/python3
+
+# tabliczka: a program for learning multiplication table
+# Copyright 2022 Marcin Owsiany <marcin@owsiany.pl>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+"""Rough timings of the hot paths, run as: python3 tabliczka_bench.py
+
+Results can be saved as a baseline, and later runs compared against it:
+
+    python3 tabliczka_bench.py --save tabliczka_bench.json
+    python3 tabliczka_bench.py --compare tabliczka_bench.json
+"""
+
+import argparse
+import collections
+import contextlib
+import io
+import itertools
+import json
+import os
+import pickle
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import unittest.mock
+
+import tabliczka
+
+
+_SIZES = (10, 20, 50, 100)
+_REPEAT = 5
+# Slowdown, relative to the baseline, above which a result is reported as a regression.
+_DEFAULT_THRESHOLD_PERCENT = 20
+# Budget for starting the program in each of the modes which do not need pygame.
+_STARTUP_BUDGET_MSEC = 150
+_STARTUP_MODES = {
+    'dump': ['--dump'],
+    'cli': ['--ui', 'cli'],  # Until the first question is shown, as stdin is empty.
+}
+
+
+def _best_usec(statement, number):
+    return min(timeit.repeat(statement, number=number, repeat=_REPEAT)) / number * 10**6
+
+
+def bench_sampler_pick(size):
+    sampler = tabliczka.WeightedSampler(random.uniform(1, 101) for _ in range(size * size))
+    last = [None]
+
+    def pick():
+        last[0] = sampler.pick(exclude=last[0])
+    return _best_usec(pick, 10000)
+
+
+def bench_sampler_update(size):
+    sampler = tabliczka.WeightedSampler([tabliczka._FREQ_UNKNOWN] * (size * size))
+    count = size * size
+    return _best_usec(lambda: sampler.update(random.randrange(count), random.uniform(1, 100)), 10000)
+
+
+def bench_due_pick(size):
+    scheduler = tabliczka.DueScheduler([random.uniform(1, 101) for _ in range(size * size)], [0.0] * (size * size))
+    clock = [0]
+
+    def pick_and_answer():
+        # Picking alone always returns the same index, so answer it as well.
+        index = scheduler.pick()
+        clock[0] += 1
+        scheduler.update(index, 50, clock[0] + tabliczka.due_interval(50) * size * size / 100)
+    return _best_usec(pick_and_answer, 10000)
+
+
+def bench_generate_problem(size):
+    state = tabliczka.State(max_factor=size)
+    return _best_usec(lambda: state.generate_problem(4), 1000)
+
+
+def bench_generate_questions(size):
+    state = tabliczka.State(max_factor=size)
+    return _best_usec(lambda: collections.deque(state.generate_questions(10000), maxlen=0), 1) / 10000
+
+
+def bench_problem(size):
+    questions = [(random.randint(1, size), random.randint(1, size)) for _ in range(1000)]
+    return _best_usec(lambda: [tabliczka.Problem(a, b, 4, size) for a, b in questions], 1) / len(questions)
+
+
+def bench_wrong_answers(size):
+    questions = [(random.randint(1, size), random.randint(1, size)) for _ in range(1000)]
+    # Bypass the cache, which would otherwise make all but the first call trivial.
+    uncached = tabliczka.wrong_answers.__wrapped__
+    return _best_usec(lambda: [uncached(a, b, size, tabliczka._WRONG_ANSWER_COUNT) for a, b in questions], 1) / len(questions)
+
+
+def bench_update_from(size):
+    state = tabliczka.State(max_factor=size)
+    problems = [state.generate_problem(4) for _ in range(100)]
+    for problem in problems:
+        problem.answered(random.choice(problem.answers()), 0, random.uniform(0, 10))
+    problems = itertools.cycle(problems)
+
+    def update():
+        state.update_from(next(problems))
+        state._unsaved_records.clear()
+        state._unsaved_answers.clear()
+    return _best_usec(update, 10000)
+
+
+def bench_settings(size):
+    args = tabliczka.get_argument_parser().parse_args(['--limit', '10'])
+    saved = dict(max_factor=size, show_feedback=False, answer_scheme='NESW')
+    return _best_usec(lambda: tabliczka.Settings(tabliczka.MemoryFS(dict(saved)), args), 10000)
+
+
+def bench_display_problem(size):
+    os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    with _temporary_state_home():
+        settings = tabliczka.Settings(tabliczka.MemoryFS(dict(max_factor=size)), tabliczka.get_argument_parser().parse_args([]))
+        state = tabliczka.State(max_factor=size)
+        problems = itertools.cycle([state.generate_problem(4) for _ in range(100)])
+        with tabliczka.GUI(settings) as gui:
+            return _best_usec(lambda: gui._display_problem(next(problems), state), 100)
+
+
+def bench_dump(size):
+    state = tabliczka.State(max_factor=size)
+
+    def dump():
+        with contextlib.redirect_stdout(io.StringIO()):
+            state.dump()
+    return _best_usec(dump, 10)
+
+
+@contextlib.contextmanager
+def _temporary_state_home():
+    with tempfile.TemporaryDirectory() as tmp, unittest.mock.patch.multiple(tabliczka,
+            _state_home=tmp,
+            _state_file=os.path.join(tmp, 'state.bin'),
+            _journal_file=os.path.join(tmp, 'state.journal'),
+            _answer_log_file=os.path.join(tmp, 'answers.log'),
+            _font_cache_filename=os.path.join(tmp, 'fonts.json')):
+        yield
+
+
+def bench_load(size):
+    with _temporary_state_home():
+        tabliczka.State(max_factor=size).compact()
+        return _best_usec(lambda: tabliczka.State.load_from(tabliczka._state_file), 100)
+
+
+def bench_load_legacy(size):
+    with _temporary_state_home():
+        frequency_map = dict((q, tabliczka._FREQ_UNKNOWN) for q in itertools.product(range(1, size + 1), range(1, size + 1)))
+        legacy_state_file = os.path.join(tabliczka._state_home, 'state.pickle')
+        with open(legacy_state_file, 'wb') as state_file:
+            for o in (frequency_map, 0, 0):
+                pickle.dump(o, state_file, protocol=-1)
+        return _best_usec(lambda: tabliczka.State.load_legacy_from(legacy_state_file), 100)
+
+
+def bench_save(size):
+    with _temporary_state_home():
+        state = tabliczka.State(max_factor=size)
+        problem = state.generate_problem(4)
+        problem.answered(problem.correct_answer(), 0)
+
+        def answer():
+            state.update_from(problem)
+            state.save()
+        usec = _best_usec(answer, 1000)
+        state.close()
+        return usec
+
+
+def startup_msec(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, XDG_STATE_HOME=tmp)
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tabliczka.py')
+        best = None
+        for _ in range(_REPEAT):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, script] + args, env=env, stdin=subprocess.DEVNULL,
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+            elapsed = (time.perf_counter() - start) * 1000
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+
+def run_benchmarks():
+    """Runs all benchmarks, printing results as they come, and returns them in the format of saved baselines."""
+    results = dict(usec_per_op={}, startup_msec={})
+    for name, bench in sorted((k, v) for k, v in globals().items() if k.startswith('bench_')):
+        name = name[len('bench_'):]
+        results['usec_per_op'][name] = {}
+        for size in _SIZES:
+            usec = bench(size)
+            results['usec_per_op'][name][str(size)] = round(usec, 3)
+            print('%-24s %3dx%-3d %8.2f usec/op' % (name, size, size, usec))
+    for mode, args in _STARTUP_MODES.items():
+        msec = startup_msec(args)
+        results['startup_msec'][mode] = round(msec, 3)
+        print('%-32s %8.2f msec%s' % ('startup_' + mode, msec, ' OVER BUDGET' if msec > _STARTUP_BUDGET_MSEC else ''))
+    return results
+
+
+def compare(baseline, results, threshold_percent):
+    """Yields (name, baseline value, new value, whether it is a regression) for results present in both."""
+    for group in ('usec_per_op', 'startup_msec'):
+        for name, new in sorted(results.get(group, {}).items()):
+            old = baseline.get(group, {}).get(name)
+            if old is None:
+                continue
+            if isinstance(new, dict):
+                for size, value in sorted(new.items(), key=lambda kv: int(kv[0])):
+                    if size in old:
+                        yield '%s %sx%s' % (name, size, size), old[size], value, value > old[size] * (1 + threshold_percent / 100)
+            else:
+                yield 'startup_' + name, old, new, new > old * (1 + threshold_percent / 100)
+
+
+def get_argument_parser():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--save', metavar='FILE', help='Save results as a baseline to FILE.')
+    parser.add_argument('--compare', metavar='FILE', help='Compare results with the baseline saved in FILE, and fail on regressions.')
+    parser.add_argument('--threshold', type=float, default=_DEFAULT_THRESHOLD_PERCENT,
+            help='Percentage by which a result may be slower than the baseline before it counts as a regression (defaults to %(default)s).')
+    return parser
+
+
+def main():
+    args = get_argument_parser().parse_args()
+    baseline = None
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+    results = run_benchmarks()
+    failed = any(msec > _STARTUP_BUDGET_MSEC for msec in results['startup_msec'].values())
+    if args.save:
+        with open(args.save, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=1, sort_keys=True)
+            baseline_file.write('\n')
+    if baseline is not None:
+        print()
+        print('Compared with %s (threshold %g%%):' % (args.compare, args.threshold))
+        for name, old, new, regressed in compare(baseline, results, args.threshold):
+            failed = failed or regressed
+            print('%-32s %10.2f -> %10.2f %+7.1f%%%s' % (name, old, new, 100 * (new / old - 1) if old else 0,
+                    ' REGRESSION' if regressed else ''))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
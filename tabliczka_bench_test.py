@@ -0,0 +1,48 @@
+#!/usr/bin/python3
+
+# tabliczka: a program for learning multiplication table
+# Copyright 2022 Marcin Owsiany <marcin@owsiany.pl>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+import unittest
+import tabliczka
+import tabliczka_bench
+
+
+class TestCompare(unittest.TestCase):
+
+    def test_compare(self):
+        baseline = dict(
+            usec_per_op=dict(problem={'10': 10.0, '20': 10.0}, removed={'10': 1.0}),
+            startup_msec=dict(cli=100.0))
+        results = dict(
+            usec_per_op=dict(problem={'10': 11.0, '20': 13.0, '50': 20.0}, added={'10': 1.0}),
+            startup_msec=dict(cli=90.0))
+        self.assertEqual(list(tabliczka_bench.compare(baseline, results, 20)), [
+            ('problem 10x10', 10.0, 11.0, False),
+            ('problem 20x20', 10.0, 13.0, True),
+            ('startup_cli', 100.0, 90.0, False)])
+
+
+class TestBenchmarks(unittest.TestCase):
+
+    def test_state_home_restored(self):
+        state_home = tabliczka._state_home
+        tabliczka_bench.bench_load(2)
+        self.assertEqual(tabliczka._state_home, state_home)
+
+
+if __name__ == '__main__':
+    unittest.main()
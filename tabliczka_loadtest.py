@@ -0,0 +1,81 @@
+#!/usr/bin/python3
+
+# tabliczka: a program for learning multiplication table
+# Copyright 2022 Marcin Owsiany <marcin@owsiany.pl>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+"""Load test for the server UI.
+
+Start the server with: python3 tabliczka.py --ui server
+and then run, for example: python3 tabliczka_loadtest.py --sessions 500 --answers 100
+"""
+
+import argparse
+import asyncio
+import random
+import statistics
+import time
+
+import tabliczka
+
+
+async def session(port, name, answer_count, correct_ratio, latencies):
+    reader, writer = await asyncio.open_connection('localhost', port)
+    await reader.readline()
+    writer.write(name.encode() + b'\n')
+    prompt = await reader.readline()
+    for _ in range(answer_count):
+        question, answers = prompt.decode().rstrip(']\n').split(' = ? [')
+        a, b = question.split(' * ')
+        correct = str(int(a) * int(b))
+        if random.random() < correct_ratio:
+            answer = correct
+        else:
+            answer = random.choice([x for x in answers.split(', ') if x != correct])
+        start = time.perf_counter()
+        writer.write(answer.encode() + b'\n')
+        prompt = await reader.readline()
+        if prompt == b':-(\n':
+            prompt = await reader.readline()
+        latencies.append(time.perf_counter() - start)
+    writer.close()
+    await writer.wait_closed()
+
+
+async def load_test(args):
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        session(args.port, 'loadtest-%d' % i, args.answers, args.correct_ratio, latencies)
+        for i in range(args.sessions)))
+    elapsed = time.perf_counter() - start
+    quantiles = statistics.quantiles(latencies, n=100)
+    print('%d sessions, %d answers in %.2f sec: %.0f answers/sec' % (
+        args.sessions, len(latencies), elapsed, len(latencies) / elapsed))
+    print('latency msec: median %.2f, p90 %.2f, p99 %.2f, max %.2f' % (
+        1000 * quantiles[49], 1000 * quantiles[89], 1000 * quantiles[98], 1000 * max(latencies)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=tabliczka._DEFAULT_SERVER_PORT)
+    parser.add_argument('--sessions', type=int, default=100, help='Number of concurrent sessions.')
+    parser.add_argument('--answers', type=int, default=100, help='Number of answers to send in each session.')
+    parser.add_argument('--correct-ratio', type=float, default=0.8, help='Fraction of answers which are correct.')
+    asyncio.run(load_test(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
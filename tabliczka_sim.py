@@ -0,0 +1,190 @@
+#!/usr/bin/python3
+
+# tabliczka: a program for learning multiplication table
+# Copyright 2022 Marcin Owsiany <marcin@owsiany.pl>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+"""Simulated learners, for evaluating the tuning constants.
+
+Each combination of the given constant values is used for a number of
+sessions of a synthetic learner, run in parallel, for example:
+
+    python3 tabliczka_sim.py --sessions 1000 --freq-max 50,100 --answer-sec-max 5,10
+"""
+
+import argparse
+import concurrent.futures
+import itertools
+import random
+import statistics
+import time
+
+import tabliczka
+
+
+# Tuning constants which can be swept.
+_PARAMETERS = ('_FREQ_MAX', '_FREQ_QUICK', '_ANSWER_SEC_MAX', '_ANSWER_SEC_QUICK', '_FREQ_LATEST_WEIGHT',
+               '_DUE_INTERVAL_SCALE')
+
+
+class Learner:
+    """A synthetic learner who gets better at a fact each time it is asked.
+
+    Every fact has a probability of being recalled, which starts random and
+    grows with each exposure. Answers get quicker as recall improves.
+    A fact is mastered once its recall probability reaches the given level.
+    """
+
+    def __init__(self, max_factor, rng, initial_recall=0.3, learning_rate=0.2,
+                 quick_sec=1.0, slow_sec=8.0, mastery=0.95):
+        self._rng = rng
+        self._learning_rate = learning_rate
+        self._quick_sec = quick_sec
+        self._slow_sec = slow_sec
+        self._mastery = mastery
+        numbers = range(1, max_factor + 1)
+        self._recall = dict((q, min(1, rng.uniform(0, 2 * initial_recall))) for q in itertools.product(numbers, numbers))
+        self._unmastered = sum(1 for r in self._recall.values() if r < mastery)
+
+    def answer(self, problem):
+        """Returns the chosen answer and the number of seconds it took."""
+        question = problem._question()
+        recall = self._recall[question]
+        if self._rng.random() < recall:
+            answer = problem.correct_answer()
+        else:
+            answer = self._rng.choice([a for a in problem.answers() if a != problem.correct_answer()])
+        latency = (self._slow_sec - (self._slow_sec - self._quick_sec) * recall) * self._rng.uniform(0.8, 1.2)
+        new_recall = recall + self._learning_rate * (1 - recall)
+        if recall < self._mastery <= new_recall:
+            self._unmastered -= 1
+        self._recall[question] = new_recall
+        return answer, latency
+
+    def mastered(self):
+        return self._unmastered == 0
+
+
+class SimulatedUI:
+
+    def __init__(self, learner, max_questions):
+        self._learner = learner
+        self._max_questions = max_questions
+        self.question_count = 0
+
+    def answer_count(self):
+        return 4
+
+    def solve_problem(self, problem, state):
+        if self._learner.mastered() or self.question_count >= self._max_questions:
+            raise tabliczka.QuitException()
+        answer, latency = self._learner.answer(problem)
+        problem.answered(answer, time.time() - latency)
+        self.question_count += 1
+
+    def provide_feedback(self, problem, state):
+        pass
+
+
+class SimulatedState(tabliczka.State):
+    """State which is never written to disk."""
+
+    def save(self):
+        self._unsaved_records.clear()
+        self._unsaved_answers.clear()
+
+    def compact(self):
+        pass
+
+
+class SimulationSettings:
+
+    def __init__(self, max_factor, scheduler):
+        self.limit = None
+        self.background_save = False
+        self.max_factor = max_factor
+        self.scheduler = scheduler
+
+
+def simulate_session(parameters, learner_options, max_factor, max_questions, seed, scheduler=tabliczka._DEFAULT_SCHEDULER):
+    """Returns whether the learner mastered all facts, number of questions asked and seconds taken."""
+    for name, value in parameters.items():
+        setattr(tabliczka, name, value)
+    random.seed(seed)
+    learner = Learner(max_factor, random.Random(seed), **learner_options)
+    ui = SimulatedUI(learner, max_questions)
+    start = time.perf_counter()
+    try:
+        tabliczka.run(ui, SimulationSettings(max_factor, scheduler), SimulatedState(max_factor=max_factor))
+    except tabliczka.QuitException:
+        pass
+    return learner.mastered(), ui.question_count, time.perf_counter() - start
+
+
+def _option_name(parameter):
+    return '--' + parameter.strip('_').lower().replace('_', '-')
+
+
+def _float_list(value):
+    return [float(v) for v in value.split(',')]
+
+
+def get_argument_parser():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sessions', type=int, default=100, help='Number of sessions per parameter set.')
+    parser.add_argument('--max-factor', type=int, default=tabliczka._DEFAULT_MAX_FACTOR)
+    parser.add_argument('--max-questions', type=int, default=100000, help='Give up on a session after this many questions.')
+    parser.add_argument('--scheduler', choices=sorted(tabliczka._SCHEDULERS), default=tabliczka._DEFAULT_SCHEDULER)
+    parser.add_argument('--workers', type=int, help='Number of processes (defaults to number of CPUs).')
+    parser.add_argument('--initial-recall', type=float, default=0.3, help='Average initial probability of recalling a fact.')
+    parser.add_argument('--learning-rate', type=float, default=0.2, help='Fraction of the remaining gap in recall closed by each exposure.')
+    for parameter in _PARAMETERS:
+        parser.add_argument(_option_name(parameter), dest=parameter, type=_float_list,
+                default=[getattr(tabliczka, parameter)], help='Comma-separated values to try.')
+    return parser
+
+
+def main():
+    args = get_argument_parser().parse_args()
+    learner_options = dict(initial_recall=args.initial_recall, learning_rate=args.learning_rate)
+    parameter_sets = [dict(zip(_PARAMETERS, values))
+                      for values in itertools.product(*(getattr(args, p) for p in _PARAMETERS))]
+
+    print(' '.join('%s' % _option_name(p)[2:] for p in _PARAMETERS),
+          '| mastered  questions(mean)  questions(median)  problems/sec')
+    with concurrent.futures.ProcessPoolExecutor(args.workers) as executor:
+        for parameters in parameter_sets:
+            results = list(executor.map(
+                simulate_session,
+                itertools.repeat(parameters, args.sessions),
+                itertools.repeat(learner_options, args.sessions),
+                itertools.repeat(args.max_factor, args.sessions),
+                itertools.repeat(args.max_questions, args.sessions),
+                range(args.sessions),
+                itertools.repeat(args.scheduler, args.sessions),
+                chunksize=max(1, args.sessions // 100)))
+            mastered = [r[1] for r in results if r[0]]
+            total_questions = sum(r[1] for r in results)
+            total_seconds = sum(r[2] for r in results)
+            print(' '.join('%g' % parameters[p] for p in _PARAMETERS),
+                  '| %7.1f%%  %15.1f  %17s  %12.0f' % (
+                      100 * len(mastered) / len(results),
+                      statistics.mean(mastered) if mastered else float('nan'),
+                      statistics.median(mastered) if mastered else 'n/a',
+                      total_questions / total_seconds if total_seconds else 0))
+
+
+if __name__ == '__main__':
+    main()
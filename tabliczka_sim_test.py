@@ -0,0 +1,52 @@
+#!/usr/bin/python3
+
+# tabliczka: a program for learning multiplication table
+# Copyright 2022 Marcin Owsiany <marcin@owsiany.pl>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+import unittest
+import tabliczka
+import tabliczka_sim
+
+
+_DEFAULT_PARAMETERS = dict((p, getattr(tabliczka, p)) for p in tabliczka_sim._PARAMETERS)
+
+
+class TestSimulation(unittest.TestCase):
+
+    def test_mastery(self):
+        mastered, questions, seconds = tabliczka_sim.simulate_session(
+                _DEFAULT_PARAMETERS, dict(learning_rate=0.5), 3, 10000, seed=1)
+        self.assertTrue(mastered)
+        self.assertGreater(questions, 0)
+
+    def test_gives_up(self):
+        mastered, questions, seconds = tabliczka_sim.simulate_session(
+                _DEFAULT_PARAMETERS, dict(learning_rate=0), 3, 50, seed=1)
+        self.assertFalse(mastered)
+        self.assertEqual(questions, 50)
+
+    def test_due_scheduler(self):
+        mastered, questions, seconds = tabliczka_sim.simulate_session(
+                _DEFAULT_PARAMETERS, dict(learning_rate=0.5), 3, 10000, seed=1, scheduler='due')
+        self.assertTrue(mastered)
+
+    def test_deterministic(self):
+        results = [tabliczka_sim.simulate_session(_DEFAULT_PARAMETERS, {}, 5, 10000, seed=7)[:2] for _ in range(2)]
+        self.assertEqual(results[0], results[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
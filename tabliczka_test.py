@@ -16,10 +16,60 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>
 
+import array
+import asyncio
+import collections
+import csv
+import contextlib
+import io
+import itertools
+import json
+import os
+import pickle
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import unittest.mock
+import data
 import tabliczka
 
 
+class TestRun(unittest.TestCase):
+
+    class UI:
+
+        def __init__(self, answers):
+            self._answers = answers
+
+        def answer_count(self):
+            return 2
+
+        def solve_problem(self, problem, state):
+            problem.answered(problem.correct_answer() if self._answers.pop(0) else '0', time.time())
+
+        def provide_feedback(self, problem, state):
+            time.sleep(0.1)
+
+    class Settings:
+        limit = 2
+        background_save = False
+        scheduler = 'sampling'
+
+    def test_summary(self):
+        state = tabliczka.State()
+        state._storage = tabliczka.DiscardingStorage()
+        with self.assertLogs(level='INFO') as logs:
+            tabliczka.run(self.UI([True, False, True]), self.Settings(), state)
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('Answered 3 questions', logs.output[0])
+        self.assertIn('without the 0.1 seconds of feedback', logs.output[0])
+
+
 class TestFrequency(unittest.TestCase):
 
     def test_frequency(self):
@@ -47,5 +97,1194 @@ class TestFrequency(unittest.TestCase):
           self.assertEqual(tabliczka.frequency(delay), expected_frequency, index)
 
 
+class NoFS:
+
+    def read(self):
+        pass
+
+    def write(self, settings):
+        pass
+
+
+class TestWrongAnswers(unittest.TestCase):
+
+    def test_close_products(self):
+        self.assertEqual(tabliczka.Problem(5, 5, 4).wrong_answers(), ('16', '20', '24', '30', '36'))
+
+    def test_edge_of_table(self):
+        self.assertEqual(tabliczka.Problem(10, 10, 4).wrong_answers(), ('49', '56', '63', '64', '70', '72', '80', '81', '90'))
+        self.assertEqual(tabliczka.Problem(10, 10, 4, 20).wrong_answers(), ('110', '121', '81', '90', '99'))
+
+    def test_small_table(self):
+        for a, b in itertools.product(range(1, 3), range(1, 3)):
+            wrong = tabliczka.Problem(a, b, 4, 2).wrong_answers()
+            self.assertGreaterEqual(len(wrong), 3)
+            self.assertNotIn(str(a * b), wrong)
+            self.assertTrue(all(int(w) > 0 for w in wrong))
+
+    def test_answers(self):
+        for a, b in itertools.product(range(1, 21), range(1, 21)):
+            for answer_count in (2, 4):
+                problem = tabliczka.Problem(a, b, answer_count, 20)
+                answers = problem.answers()
+                self.assertEqual(len(set(answers)), answer_count)
+                self.assertIn(problem.correct_answer(), answers)
+
+    def test_memoized(self):
+        self.assertIs(tabliczka.Problem(3, 4, 4).wrong_answers(), tabliczka.Problem(3, 4, 2).wrong_answers())
+
+
+class TestWeightedSampler(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(0)
+
+    def test_total(self):
+        sampler = tabliczka.WeightedSampler([1, 2.5, 3])
+        self.assertEqual(sampler.total(), 6.5)
+        sampler.update(1, 0.5)
+        self.assertEqual(sampler.total(), 4.5)
+        self.assertEqual(sampler.weight(1), 0.5)
+
+    def test_pick_is_proportional(self):
+        sampler = tabliczka.WeightedSampler([1, 0, 3, 0.5])
+        counts = collections.Counter(sampler.pick() for _ in range(45000))
+        self.assertEqual(counts[1], 0)
+        self.assertAlmostEqual(counts[0] / 45000, 1 / 4.5, delta=0.01)
+        self.assertAlmostEqual(counts[2] / 45000, 3 / 4.5, delta=0.01)
+        self.assertAlmostEqual(counts[3] / 45000, 0.5 / 4.5, delta=0.01)
+
+    def test_pick_excluded(self):
+        sampler = tabliczka.WeightedSampler([1, 100, 1])
+        counts = collections.Counter(sampler.pick(exclude=1) for _ in range(10000))
+        self.assertEqual(counts[1], 0)
+        self.assertAlmostEqual(counts[0] / 10000, 0.5, delta=0.03)
+
+    def test_pick_after_update(self):
+        sampler = tabliczka.WeightedSampler([1, 1, 1])
+        sampler.update(0, 0)
+        sampler.update(2, 0)
+        self.assertEqual(set(sampler.pick() for _ in range(100)), {1})
+
+    def test_pick_many(self):
+        sampler = tabliczka.WeightedSampler([1, 0, 3, 0.5])
+        with unittest.mock.patch.object(tabliczka, '_GENERATE_BATCH_SIZE', 7):
+            picked = list(sampler.pick_many(1000, exclude=2))
+        self.assertEqual(len(picked), 1000)
+        self.assertNotEqual(picked[0], 2)
+        self.assertNotIn(1, picked)
+        self.assertFalse(any(a == b for a, b in zip(picked, picked[1:])))
+
+
+class TestDueScheduler(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(0)
+
+    def test_pick_due_first(self):
+        scheduler = tabliczka.DueScheduler([1, 1, 0, 1], [5, 3, 0, 4])
+        self.assertEqual(scheduler.pick(), 1)
+        self.assertEqual(scheduler.pick(exclude=1), 3)
+        scheduler.update(1, 1, 10)
+        self.assertEqual(scheduler.pick(), 3)
+        scheduler.update(3, 1, 11)
+        self.assertEqual(scheduler.pick(), 0)
+        self.assertEqual(scheduler.pick(exclude=0), 1)
+
+    def test_stale_entries_dropped(self):
+        scheduler = tabliczka.DueScheduler([1, 1], [0, 0])
+        for due in range(100):
+            scheduler.update(0, 1, due)
+        self.assertLessEqual(len(scheduler._heap), 4)
+        self.assertEqual(scheduler.pick(), 1)
+
+    def test_pick_many(self):
+        scheduler = tabliczka.DueScheduler([100, 1, 1], [0, 0, 0])
+        picked = list(scheduler.pick_many(30, exclude=0))
+        self.assertNotEqual(picked[0], 0)
+        self.assertFalse(any(a == b for a, b in zip(picked, picked[1:])))
+        self.assertGreater(picked.count(0), 10)
+
+
+class TestState(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(1)
+
+    def test_generate_problem_does_not_repeat(self):
+        state = tabliczka.State()
+        previous = None
+        for _ in range(1000):
+            question = state.generate_problem(4)._question()
+            self.assertNotEqual(question, previous)
+            previous = question
+
+    def test_generate_problem_within_max_factor(self):
+        state = tabliczka.State(max_factor=3)
+        questions = set(state.generate_problem(2)._question() for _ in range(1000))
+        self.assertEqual(questions, set(itertools.product(range(1, 4), range(1, 4))))
+
+    def test_generate_questions(self):
+        state = tabliczka.State(max_factor=3)
+        last = state.generate_problem(2)._question()
+        questions = list(state.generate_questions(1000))
+        self.assertNotEqual(questions[0], last)
+        self.assertEqual(set(questions), set(itertools.product(range(1, 4), range(1, 4))))
+        self.assertNotEqual(state.generate_problem(2)._question(), questions[-1])
+
+    def test_generate_with_saved_scheduler(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            patcher = unittest.mock.patch.multiple(tabliczka, _state_home=tmp,
+                    _state_file=os.path.join(tmp, 'state.bin'), _journal_file=os.path.join(tmp, 'state.journal'),
+                    _settings_filename=os.path.join(tmp, 'settings.json'))
+            output = os.path.join(tmp, 'worksheet.txt')
+            with patcher, unittest.mock.patch.object(tabliczka.DueScheduler, 'pick_many', autospec=True,
+                    side_effect=tabliczka.DueScheduler.pick_many) as pick_many:
+                tabliczka.FS().write(dict(scheduler='due'))
+                tabliczka._main(tabliczka.get_argument_parser().parse_args(['--generate', '5', '--output', output]))
+            pick_many.assert_called_once()
+            with open(output) as worksheet:
+                self.assertEqual(len(worksheet.readlines()), 5)
+
+    def test_write_worksheet(self):
+        output = io.StringIO()
+        tabliczka.write_worksheet(tabliczka.State(), 5, 4, output)
+        lines = output.getvalue().splitlines()
+        self.assertEqual(len(lines), 5)
+        for line in lines:
+            question, answers = line.rstrip(']').split(' = ? [')
+            a, b = question.split(' * ')
+            self.assertIn(str(int(a) * int(b)), answers.split(', '))
+            self.assertEqual(len(answers.split(', ')), 4)
+
+    def test_due_scheduler(self):
+        state = tabliczka.State(max_factor=3)
+        state.use_scheduler('due')
+        asked = []
+        for _ in range(9):
+            problem = state.generate_problem(2)
+            problem.answered(problem.correct_answer(), 0)
+            state.update_from(problem)
+            asked.append(problem._question())
+        self.assertEqual(set(asked), set(itertools.product(range(1, 4), range(1, 4))))
+
+    def test_prefetch_problem(self):
+        state = tabliczka.State()
+        problem = state.generate_problem(4)
+        prefetched = state.prefetch_problem(4)
+        self.assertIs(state.prefetch_problem(4), prefetched)
+        self.assertNotEqual(prefetched._question(), problem._question())
+        problem.answered(problem.correct_answer(), 0)
+        state.update_from(problem)
+        self.assertIs(state.generate_problem(4), prefetched)
+        self.assertIsNot(state.generate_problem(4), prefetched)
+
+    def test_prefetch_problem_discarded(self):
+        state = tabliczka.State()
+        state.generate_problem(4)
+        prefetched = state.prefetch_problem(4)
+        self.assertIsNot(state.prefetch_problem(2), prefetched)
+        prefetched = state.prefetch_problem(2)
+        prefetched.answered(prefetched.correct_answer(), 0)
+        state.update_from(prefetched)
+        self.assertIsNot(state.prefetch_problem(2), prefetched)
+
+    def test_update_from(self):
+        state = tabliczka.State(max_factor=3)
+        problem = tabliczka.Problem(2, 3, 2)
+        problem.answered('6', 0)
+        state.update_from(problem)
+        self.assertEqual(state._frequencies[state._index((2, 3))], tabliczka._FREQ_MAX)
+        self.assertEqual(state.correct_count(), 1)
+
+    def test_load_old_format(self):
+        frequency_map = dict((q, tabliczka._FREQ_UNKNOWN) for q in itertools.product(range(1, 11), range(1, 11)))
+        frequency_map[(7, 8)] = 42
+        with tempfile.TemporaryDirectory() as tmp:
+            file_name = os.path.join(tmp, 'state.pickle')
+            with open(file_name, 'wb') as state_file:
+                pickle.dump(frequency_map, state_file)
+            state = tabliczka.State.load_legacy_from(file_name)
+        self.assertEqual(state.max_factor(), 10)
+        self.assertEqual(state._frequencies[state._index((7, 8))], 42)
+        self.assertEqual(state.correct_count(), 0)
+
+    def test_grow_and_shrink(self):
+        state = tabliczka.State(max_factor=2)
+        state._update_frequency((2, 1), 5)
+        grown = tabliczka.State(state._frequencies, max_factor=4)
+        self.assertEqual(len(grown._frequencies), 16)
+        self.assertEqual(grown._frequencies[grown._index((2, 1))], 5)
+        self.assertEqual(grown._frequencies[grown._index((4, 4))], tabliczka._FREQ_UNKNOWN)
+        shrunk = tabliczka.State(grown._frequencies, max_factor=2)
+        self.assertEqual(len(shrunk._frequencies), 16)
+        self.assertEqual(shrunk._frequencies[shrunk._index((2, 1))], 5)
+        self.assertEqual(set(shrunk.generate_problem(2)._question() for _ in range(100)),
+                         set(itertools.product(range(1, 3), range(1, 3))))
+
+    def test_dump(self):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            tabliczka.State(max_factor=2).dump()
+        self.assertEqual(output.getvalue(), '\n'.join([
+            'Frequency map:',
+            '   |    1     2 ',
+            '---+------------',
+            ' 1 | 101.0 101.0',
+            ' 2 | 101.0 101.0',
+            'Correct: 0',
+            'Errors: 0',
+            '']))
+
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self._state_file = os.path.join(tmp.name, 'state.bin')
+        self._journal_file = os.path.join(tmp.name, 'state.journal')
+        self._answer_log_file = os.path.join(tmp.name, 'answers.log')
+        patcher = unittest.mock.patch.multiple(tabliczka,
+                _state_home=tmp.name, _state_file=self._state_file, _journal_file=self._journal_file,
+                _answer_log_file=self._answer_log_file)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _answer(self, state, a, b, answer):
+        problem = tabliczka.Problem(a, b, 2)
+        problem.answered(answer, 0)
+        state.update_from(problem)
+        state.save()
+
+    def _load(self):
+        return tabliczka.State.load_from(self._state_file, None, self._journal_file)
+
+    def test_replay(self):
+        state = tabliczka.State()
+        self._answer(state, 2, 3, '6')
+        snapshot_size = os.path.getsize(self._state_file)
+        self._answer(state, 4, 5, '21')
+        self._answer(state, 6, 7, '42')
+        state.close()
+        self.assertEqual(os.path.getsize(self._state_file), snapshot_size)
+
+        loaded = self._load()
+        self.assertEqual(loaded._frequencies, state._frequencies)
+        self.assertEqual(loaded.correct_count(), 2)
+        self.assertEqual(loaded.error_count(), 1)
+
+    def test_incomplete_record_ignored(self):
+        state = tabliczka.State()
+        self._answer(state, 2, 3, '6')
+        self._answer(state, 4, 5, '20')
+        state.close()
+        with open(self._journal_file, 'ab') as journal_file:
+            journal_file.write(b'\x01\x02')
+        self.assertEqual(self._load().correct_count(), 2)
+
+    def test_stale_journal_ignored(self):
+        state = tabliczka.State()
+        self._answer(state, 2, 3, '6')
+        self._answer(state, 4, 5, '20')
+        state.close()
+        with open(self._journal_file, 'rb') as journal_file:
+            journal = journal_file.read()
+        state.compact()
+        with open(self._journal_file, 'wb') as journal_file:
+            journal_file.write(journal)
+        self.assertEqual(self._load().correct_count(), 2)
+
+    def test_compaction(self):
+        state = tabliczka.State()
+        with unittest.mock.patch.object(tabliczka, '_JOURNAL_COMPACT_RECORDS', 2):
+            for _ in range(5):
+                self._answer(state, 2, 3, '6')
+        state.close()
+        with open(self._journal_file, 'rb') as journal_file:
+            self.assertEqual(len(journal_file.read()), tabliczka._JOURNAL_HEADER.size + tabliczka._JOURNAL_RECORD.size)
+        self.assertEqual(self._load().correct_count(), 5)
+
+    def test_replay_beyond_saved_size(self):
+        state = tabliczka.State(max_factor=12)
+        tabliczka.State(max_factor=10).compact()
+        state._generation = 1
+        state._journal_records = 0
+        self._answer(state, 12, 11, '132')
+        state.close()
+        loaded = tabliczka.State.load_from(self._state_file, 10, self._journal_file)
+        self.assertEqual(loaded.max_factor(), 10)
+        self.assertEqual(loaded._frequencies[loaded._index((12, 11))], tabliczka._FREQ_MAX)
+
+    def test_binary_format(self):
+        state = tabliczka.State(max_factor=3)
+        self._answer(state, 2, 3, '6')
+        with open(self._state_file, 'rb') as state_file:
+            content = state_file.read()
+        self.assertEqual(content[:4], b'TABL')
+        self.assertEqual(len(content), tabliczka._STATE_HEADER.size + 2 * 9 * 8)
+        self.assertEqual(tabliczka._STATE_HEADER.unpack_from(content)[1:], (2, 3, 1, 0, 1))
+
+    def test_version_1(self):
+        with open(self._state_file, 'wb') as state_file:
+            state_file.write(tabliczka._STATE_HEADER.pack(b'TABL', 1, 2, 3, 4, 5))
+            array.array('d', [1.0, 2.0, 3.0, 4.0]).tofile(state_file)
+        loaded = self._load()
+        self.assertEqual(list(loaded._frequencies), [1.0, 2.0, 3.0, 4.0])
+        self.assertEqual(list(loaded._dues), [0.0] * 4)
+        self.assertEqual((loaded.correct_count(), loaded.error_count()), (3, 4))
+
+    def test_dues(self):
+        state = tabliczka.State(max_factor=3)
+        self._answer(state, 2, 3, '6')
+        self._answer(state, 1, 1, '2')
+        self.assertEqual(state._dues[state._index((1, 1))], 1 + tabliczka.due_interval(tabliczka._FREQ_MAX))
+        self.assertEqual(self._load()._dues, state._dues)
+        state.compact()
+        self.assertEqual(self._load()._dues, state._dues)
+
+    def test_unsupported_version(self):
+        tabliczka.State(max_factor=3).compact()
+        with open(self._state_file, 'r+b') as state_file:
+            state_file.seek(4)
+            state_file.write(b'\x03\x00')
+        with self.assertRaisesRegex(ValueError, 'version 3'):
+            self._load()
+
+    def test_migration(self):
+        legacy_state_file = os.path.join(os.path.dirname(self._state_file), 'state.pickle')
+        with open(legacy_state_file, 'wb') as state_file:
+            pickle.dump(dict(((a, b), 50.0) for a, b in itertools.product(range(1, 11), range(1, 11))), state_file)
+            pickle.dump(4, state_file)
+            pickle.dump(2, state_file)
+        state = tabliczka.State.load()
+        self.assertTrue(os.path.exists(legacy_state_file))
+        self.assertFalse(os.path.exists(self._state_file))
+        self.assertEqual((state.correct_count(), state.error_count()), (4, 2))
+        state = tabliczka.State.load(migrate=True)
+        self.assertFalse(os.path.exists(legacy_state_file))
+        loaded = self._load()
+        self.assertEqual(loaded._frequencies, state._frequencies)
+        self.assertEqual(set(loaded._frequencies), {50.0})
+        self.assertEqual((loaded.correct_count(), loaded.error_count()), (4, 2))
+
+    def test_malicious_pickle(self):
+        pwned = os.path.join(os.path.dirname(self._state_file), 'pwned')
+
+        class Exploit:
+            def __reduce__(self):
+                return (os.mkdir, (pwned,))
+        for file_name in (self._state_file, os.path.join(os.path.dirname(self._state_file), 'state.pickle')):
+            with open(file_name, 'wb') as state_file:
+                pickle.dump(Exploit(), state_file)
+        self.assertRaises(ValueError, self._load)
+        self.assertRaises(pickle.UnpicklingError, tabliczka.State.load_legacy_from, file_name)
+        with self.assertLogs(level='WARNING'):
+            state = tabliczka.State.load(migrate=True)
+        self.assertEqual(state.correct_count(), 0)
+        self.assertFalse(os.path.exists(pwned))
+
+    def test_background_save(self):
+        state = tabliczka.State()
+        state.save_in_background()
+        for _ in range(10):
+            self._answer(state, 2, 3, '6')
+        self._answer(state, 4, 5, '21')
+        state.close()
+        loaded = self._load()
+        self.assertEqual(loaded._frequencies, state._frequencies)
+        self.assertEqual(loaded.correct_count(), 10)
+        self.assertEqual(loaded.error_count(), 1)
+        self.assertEqual(sum(len(block['a']) for block in tabliczka.read_answer_log(self._answer_log_file)), 11)
+
+
+class TestAnswerLog(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self._file_name = os.path.join(tmp.name, 'answers.log')
+
+    def test_blocks(self):
+        log = tabliczka.AnswerLog(self._file_name)
+        log.append([(2, 3, 6, True, 1.5, 86400.0), (4, 5, -1, False, 3.0, 86400.0)])
+        log.append([])
+        log.close()
+        log = tabliczka.AnswerLog(self._file_name)
+        log.append([(6, 7, 41, False, 0.5, 2 * 86400.0)])
+        log.close()
+        blocks = list(tabliczka.read_answer_log(self._file_name))
+        self.assertEqual(len(blocks), 2)
+        self.assertEqual(list(blocks[0]['a']), [2, 4])
+        self.assertEqual(list(blocks[0]['answer']), [6, -1])
+        self.assertEqual(list(blocks[0]['correct']), [1, 0])
+        self.assertEqual(list(blocks[1]['latency']), [0.5])
+
+    def test_incomplete_block_ignored(self):
+        log = tabliczka.AnswerLog(self._file_name)
+        log.append([(2, 3, 6, True, 1.5, 0.0)])
+        log.close()
+        with open(self._file_name, 'ab') as log_file:
+            log_file.write(tabliczka._ANSWER_LOG_BLOCK_HEADER.pack(5) + b'\x01\x02')
+        self.assertEqual(len(list(tabliczka.read_answer_log(self._file_name))), 1)
+
+    def test_answers_not_fitting(self):
+        problem = tabliczka.Problem(2, 3, 4)
+        records = []
+        for answer in ('6', '99999999999', '\u00b2', 'x', '-6'):
+            problem.answered(answer, 0, 1)
+            records.append((2, 3, problem.answer_number(), problem.answered_correctly(), 1.0, 0.0))
+        log = tabliczka.AnswerLog(self._file_name)
+        log.append(records)
+        log.close()
+        block, = tabliczka.read_answer_log(self._file_name)
+        self.assertEqual(list(block['answer']), [6, -1, -1, -1, -1])
+
+    def test_stats(self):
+        log = tabliczka.AnswerLog(self._file_name)
+        log.append([(2, 3, 6, True, 1.0, 0.0)] * 8 + [(2, 3, 5, False, 5.0, 0.0)] * 2)
+        log.append([(4, 5, 20, True, 200.0, 0.0)])
+        log.close()
+        stats = tabliczka.AnswerStats()
+        for block in tabliczka.read_answer_log(self._file_name):
+            stats.add_block(block)
+        lines = list(stats.lines())
+        self.assertEqual(lines[1].split(), ['2*3', '10', '80.0%', '1.1s', '5.4s'])
+        self.assertEqual(lines[2].split(), ['4*5', '1', '100.0%', '>86s', '>86s'])
+        self.assertEqual(lines[-1].split()[1:], ['11', '81.8%', '19.8s'])
+
+
+class TestServer(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self._state_home = tmp.name
+        patcher = unittest.mock.patch.object(tabliczka, '_state_home', tmp.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self._settings = tabliczka.Settings(NoFS(), tabliczka.get_argument_parser().parse_args(['--limit', '2']))
+
+    async def _session(self, port, name, answers):
+        reader, writer = await asyncio.open_connection('localhost', port)
+        lines = [await reader.readline()]
+        writer.write(name.encode() + b'\n')
+        for answer in answers:
+            prompt = (await reader.readline()).decode()
+            lines.append(prompt)
+            a, b = prompt.split(' = ?')[0].split(' * ')
+            writer.write((str(int(a) * int(b)) if answer else 'wrong').encode() + b'\n')
+            if not answer:
+                lines.append(await reader.readline())
+        lines.append(await reader.read())
+        writer.close()
+        return lines
+
+    def test_sessions(self):
+        async def test():
+            server = tabliczka.Server(self._settings)
+            asyncio_server = await server.start(0)
+            port = asyncio_server.sockets[0].getsockname()[1]
+            results = await asyncio.gather(
+                    self._session(port, 'alice', [True, False, True]),
+                    self._session(port, 'bob', [True, True]),
+                    self._session(port, 'bad name', []))
+            asyncio_server.close()
+            await asyncio_server.wait_closed()
+            self.assertEqual(server.learner_count(), 2)
+            await server.evict_idle_learners(time.monotonic() + tabliczka._SERVER_IDLE_TIMEOUT_SEC)
+            self.assertEqual(server.learner_count(), 0)
+            await server.close()
+            return results
+
+        alice, bob, bad = asyncio.run(test())
+        self.assertEqual(alice[0], b'Name?\n')
+        self.assertEqual(alice[3], b':-(\n')
+        self.assertEqual(alice[-1], b'')
+        self.assertEqual(len(bob), 4)
+        self.assertEqual(bad[-1], b'Invalid name.\n')
+        alice_state = tabliczka.State.load(state_home=os.path.join(self._state_home, 'learners', 'alice'))
+        self.assertEqual((alice_state.correct_count(), alice_state.error_count()), (2, 1))
+
+    def test_io_off_event_loop(self):
+        threads = []
+        load = tabliczka.State.load
+        write = tabliczka.State._write
+
+        def recording_load(*args, **kwargs):
+            threads.append(threading.current_thread())
+            return load(*args, **kwargs)
+
+        def recording_write(state, pending_write):
+            threads.append(threading.current_thread())
+            if pending_write.snapshot is not None:
+                time.sleep(0.1)  # like a slow disk
+            write(state, pending_write)
+
+        async def tick(gaps):
+            while True:
+                start = time.monotonic()
+                await asyncio.sleep(0.01)
+                gaps.append(time.monotonic() - start)
+
+        async def test():
+            server = tabliczka.Server(self._settings)
+            asyncio_server = await server.start(0)
+            port = asyncio_server.sockets[0].getsockname()[1]
+            await asyncio.gather(self._session(port, 'dan', [True, True]),
+                    *(self._session(port, 'carol', [True, True]) for _ in range(3)))
+            asyncio_server.close()
+            await asyncio_server.wait_closed()
+            self.assertEqual(server.learner_count(), 2)
+            gaps = []
+            ticker = asyncio.create_task(tick(gaps))
+            await server.evict_idle_learners(time.monotonic() + tabliczka._SERVER_IDLE_TIMEOUT_SEC)
+            ticker.cancel()
+            self.assertLess(max(gaps), 0.1)
+            await server.close()
+
+        with unittest.mock.patch.object(tabliczka.State, 'load', recording_load), \
+                unittest.mock.patch.object(tabliczka.State, '_write', recording_write):
+            asyncio.run(test())
+        self.assertEqual(len([t for t in threads if t.name != 'tabliczka-writer']), 2)
+        self.assertEqual(len(set(t for t in threads if t.name == 'tabliczka-writer')), 1)
+        self.assertNotIn(threading.main_thread(), threads)
+        carol_state = tabliczka.State.load(state_home=os.path.join(self._state_home, 'learners', 'carol'))
+        self.assertEqual(carol_state.correct_count(), 6)
+
+
+class TestProfileStore(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self._file_name = os.path.join(tmp.name, 'profiles.sqlite')
+        self._store = tabliczka.ProfileStore(self._file_name)
+        self.addCleanup(self._store.close)
+
+    def _answer(self, state, a, b, answer):
+        problem = tabliczka.Problem(a, b, 2)
+        problem.answered(answer, 0)
+        state.update_from(problem)
+        state.save()
+
+    def test_wal(self):
+        self.assertEqual(self._store._db.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+
+    def test_closed_by_main(self):
+        closed = []
+        close = tabliczka.ProfileStore.close
+
+        def recording_close(store):
+            closed.append(store)
+            close(store)
+        with unittest.mock.patch.object(tabliczka, '_profiles_filename', self._file_name), \
+                unittest.mock.patch.object(tabliczka.ProfileStore, 'close', recording_close), \
+                contextlib.redirect_stdout(io.StringIO()):
+            tabliczka._main(tabliczka.get_argument_parser().parse_args(['--profile', 'alice', '--dump']))
+        self.assertEqual(len(closed), 1)
+
+    def test_settings(self):
+        fs = tabliczka.ProfileFS(self._store, 'alice')
+        self.assertIsNone(fs.read())
+        fs.write(dict(limit=3))
+        self.assertEqual(fs.read(), dict(limit=3))
+        self.assertIsNone(tabliczka.ProfileFS(self._store, 'bob').read())
+
+    def test_state(self):
+        alice = tabliczka.State.load_profile(self._store, 'alice')
+        self._answer(alice, 2, 3, '6')
+        self._answer(alice, 4, 5, '21')
+        bob = tabliczka.State.load_profile(self._store, 'bob', 12)
+        self._answer(bob, 12, 12, '144')
+        self._answer(alice, 6, 7, '42')
+
+        other_store = tabliczka.ProfileStore(self._file_name)
+        self.addCleanup(other_store.close)
+        self.assertEqual(other_store.profile_names(), ['alice', 'bob'])
+        loaded_alice = tabliczka.State.load_profile(other_store, 'alice')
+        self.assertEqual(loaded_alice._frequencies, alice._frequencies)
+        self.assertEqual((loaded_alice.correct_count(), loaded_alice.error_count()), (2, 1))
+        loaded_bob = tabliczka.State.load_profile(other_store, 'bob')
+        self.assertEqual(loaded_bob.max_factor(), 12)
+        self.assertEqual(loaded_bob.correct_count(), 1)
+
+    def test_compact(self):
+        state = tabliczka.State.load_profile(self._store, 'alice')
+        for _ in range(3):
+            self._answer(state, 2, 3, '6')
+        state.compact()
+        loaded = tabliczka.State.load_profile(self._store, 'alice')
+        self.assertEqual(loaded.correct_count(), 3)
+        self.assertEqual(loaded._frequencies, state._frequencies)
+
+    def test_dues(self):
+        state = tabliczka.State.load_profile(self._store, 'alice', 3)
+        self._answer(state, 2, 3, '6')
+        self._answer(state, 1, 1, '2')
+        self.assertEqual(tabliczka.State.load_profile(self._store, 'alice')._dues, state._dues)
+        state.compact()
+        self.assertEqual(tabliczka.State.load_profile(self._store, 'alice')._dues, state._dues)
+
+    def test_add_due_column(self):
+        self._store.close()
+        db = sqlite3.connect(self._file_name)
+        with db:
+            db.execute('DROP TABLE frequencies')
+            db.execute('CREATE TABLE frequencies (profile TEXT, a INTEGER, b INTEGER, frequency REAL, PRIMARY KEY (profile, a, b))')
+            db.execute("INSERT INTO frequencies VALUES ('alice', 1, 1, 5.0)")
+            db.execute("INSERT INTO profiles (name) VALUES ('alice')")
+        db.close()
+        self._store = tabliczka.ProfileStore(self._file_name)
+        self.assertEqual(list(self._store.read_state('alice')[3]), [0.0])
+
+    def test_answer_log(self):
+        state = tabliczka.State.load_profile(self._store, 'a/b')
+        self._answer(state, 2, 3, '6')
+        state.close()
+        file_name = self._store.answer_log_file_name('a/b')
+        self.assertEqual(os.path.basename(file_name), 'a%2Fb.log')
+        self.assertEqual([list(block['b']) for block in tabliczka.read_answer_log(file_name)], [[3]])
+
+
+class TestReport(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self._root = os.path.join(tmp.name, 'school')
+        self._output = os.path.join(tmp.name, 'report')
+        self._answer(tabliczka.State.load(3, os.path.join(self._root, 'alice')), [(2, 3, '6'), (1, 1, '2')])
+        os.makedirs(os.path.join(self._root, 'bob'))
+        with open(os.path.join(self._root, 'bob', 'state.pickle'), 'wb') as state_file:
+            pickle.dump(dict(((a, b), 40.0) for a, b in itertools.product(range(1, 3), range(1, 3))), state_file)
+            pickle.dump(7, state_file)
+            pickle.dump(1, state_file)
+        os.makedirs(os.path.join(self._root, 'carol'))
+        with open(os.path.join(self._root, 'carol', 'state.bin'), 'wb') as state_file:
+            state_file.write(b'TABL\x01')
+        store = tabliczka.ProfileStore(os.path.join(self._root, 'profiles.sqlite'))
+        self._answer(tabliczka.State.load_profile(store, 'dave', 3), [(2, 3, '7')])
+        store.close()
+
+    def _answer(self, state, answers):
+        for a, b, answer in answers:
+            problem = tabliczka.Problem(a, b, 2)
+            problem.answered(answer, 0)
+            state.update_from(problem)
+            state.save()
+        state.close()
+
+    def test_csv(self):
+        with self.assertLogs(level='WARNING'):
+            tabliczka.write_report([self._root], self._output, 'csv', workers=2)
+        with open(os.path.join(self._output, 'learners.csv')) as report_file:
+            learners = dict((row['name'], row) for row in csv.DictReader(report_file))
+        self.assertEqual(sorted(learners), ['alice', 'bob', 'carol', 'profiles.sqlite:dave'])
+        self.assertEqual((learners['alice']['correct_count'], learners['alice']['error_count']), ('1', '1'))
+        self.assertEqual(learners['alice']['hardest_question'], '1 * 1 = ?')
+        self.assertEqual(learners['bob']['questions_answered'], '4')
+        self.assertNotEqual(learners['carol']['error'], '')
+        self.assertEqual(learners['profiles.sqlite:dave']['error_count'], '1')
+        with open(os.path.join(self._output, 'questions.csv')) as report_file:
+            rows = list(csv.reader(report_file))
+        self.assertEqual(rows[0], ['a \\ b', '1', '2', '3'])
+        self.assertEqual(rows[1][1], '%.1f' % ((tabliczka._FREQ_MAX + 40) / 2))
+        self.assertEqual(rows[2][3], '%.1f' % tabliczka._FREQ_MAX)
+        self.assertEqual(rows[3][3], '')
+
+    def test_json(self):
+        with self.assertLogs(level='WARNING'):
+            tabliczka.write_report([self._root], self._output, 'json', workers=1)
+        with open(os.path.join(self._output, 'report.json')) as report_file:
+            report = json.load(report_file)
+        self.assertEqual(len(report['learners']), 4)
+        question = [q for q in report['questions'] if (q['a'], q['b']) == (2, 3)][0]
+        self.assertEqual(question['learners'], 2)
+
+
+    def test_malicious_state_file(self):
+        pwned = os.path.join(self._root, 'pwned')
+
+        class Exploit:
+            def __reduce__(self):
+                return (os.mkdir, (pwned,))
+        os.makedirs(os.path.join(self._root, 'eve'))
+        with open(os.path.join(self._root, 'eve', 'state.bin'), 'wb') as state_file:
+            pickle.dump(Exploit(), state_file)
+        os.makedirs(os.path.join(self._root, 'mallory'))
+        with open(os.path.join(self._root, 'mallory', 'state.pickle'), 'wb') as state_file:
+            pickle.dump(Exploit(), state_file)
+        with self.assertLogs(level='WARNING'):
+            tabliczka.write_report([self._root], self._output, 'csv', workers=1)
+        self.assertFalse(os.path.exists(pwned))
+        with open(os.path.join(self._output, 'learners.csv')) as report_file:
+            learners = dict((row['name'], row) for row in csv.DictReader(report_file))
+        self.assertIn('not a state file', learners['eve']['error'])
+        self.assertIn('not allowed', learners['mallory']['error'])
+
+    def test_other_databases(self):
+        with open(os.path.join(self._root, 'broken.sqlite'), 'w') as broken_file:
+            broken_file.write('garbage')
+        other_file_name = os.path.join(self._root, 'alice', 'other.sqlite')
+        other = sqlite3.connect(other_file_name)
+        other.execute('CREATE TABLE things (name TEXT)')
+        other.commit()
+        other.close()
+        with self.assertLogs(level='WARNING'):
+            tabliczka.write_report([self._root], self._output, 'csv', workers=1)
+        with open(os.path.join(self._output, 'learners.csv')) as report_file:
+            learners = dict((row['name'], row) for row in csv.DictReader(report_file))
+        self.assertEqual(sorted(learners), ['alice', 'bob', 'broken.sqlite', 'carol', 'profiles.sqlite:dave'])
+        self.assertIn('not a database', learners['broken.sqlite']['error'])
+        self.assertEqual(learners['profiles.sqlite:dave']['error_count'], '1')
+        other = sqlite3.connect(other_file_name)
+        self.assertEqual([row[0] for row in other.execute("SELECT name FROM sqlite_master WHERE type = 'table'")], ['things'])
+        other.close()
+
+
+class TestBackgroundWriter(unittest.TestCase):
+
+    def test_coalescing(self):
+        written = []
+        started = threading.Event()
+        unblock = threading.Event()
+
+        def write(pending_write):
+            started.set()
+            unblock.wait()
+            written.append((pending_write.snapshot, pending_write.records))
+
+        writer = tabliczka.BackgroundWriter(write)
+        writer.submit(tabliczka.PendingWrite(b'1', [1]))
+        started.wait()
+        writer.submit(tabliczka.PendingWrite(None, [2]))
+        writer.submit(tabliczka.PendingWrite(b'2', [3]))
+        writer.submit(tabliczka.PendingWrite(None, [4]))
+        writer.submit(tabliczka.PendingWrite(None, [5]))
+        unblock.set()
+        writer.stop()
+        self.assertEqual(written, [(b'1', [1]), (b'2', [3, 4, 5])])
+        self.assertEqual(writer.coalesced_count(), 3)
+
+
+    def test_shared(self):
+        written = []
+        started = threading.Event()
+        unblock = threading.Event()
+
+        def write_a(pending_write):
+            started.set()
+            unblock.wait()
+            written.append(('a', pending_write.records))
+
+        def write_b(pending_write):
+            written.append(('b', pending_write.records))
+
+        writer = tabliczka.BackgroundWriter()
+        writer.submit(tabliczka.PendingWrite(None, [1]), write_a)
+        started.wait()
+        writer.submit(tabliczka.PendingWrite(None, [2]), write_b)
+        writer.submit(tabliczka.PendingWrite(None, [3]), write_a)
+        writer.submit(tabliczka.PendingWrite(None, [4]), write_b)
+        unblock.set()
+        writer.wait_for(write_b)
+        self.assertIn(('b', [2, 4]), written)
+        writer.stop()
+        self.assertEqual(sorted(written), [('a', [1]), ('a', [3]), ('b', [2, 4])])
+
+
+class FakeFont:
+
+    def __init__(self):
+        self.rendered = []
+
+    def render(self, text, antialias, color):
+        self.rendered.append(text)
+        return (text, color)
+
+
+class TestTextCache(unittest.TestCase):
+
+    def test_cached(self):
+        font = FakeFont()
+        cache = tabliczka.TextCache(10)
+        self.assertEqual(cache.render(font, '42', (0, 0, 0)), ('42', (0, 0, 0)))
+        self.assertEqual(cache.render(font, '42', (0, 0, 0)), ('42', (0, 0, 0)))
+        self.assertEqual(cache.render(font, '42', (1, 1, 1)), ('42', (1, 1, 1)))
+        self.assertEqual(font.rendered, ['42', '42'])
+        self.assertAlmostEqual(cache.hit_rate(), 1 / 3)
+
+    def test_least_recently_used_evicted(self):
+        font = FakeFont()
+        cache = tabliczka.TextCache(2)
+        cache.render(font, 'a', None)
+        cache.render(font, 'b', None)
+        cache.render(font, 'a', None)
+        cache.render(font, 'c', None)
+        cache.render(font, 'a', None)
+        cache.render(font, 'b', None)
+        self.assertEqual(font.rendered, ['a', 'b', 'c', 'b'])
+
+
+class TestData(unittest.TestCase):
+
+    def test_images_cached(self):
+        self.assertIs(data.correct_image(), data.correct_image())
+        self.assertIsNot(data.correct_image(), data.error_image())
+
+    def test_preload(self):
+        previous = data.correct_image()
+        data.preload()
+        self.assertIsNot(data.correct_image(), previous)
+        self.assertEqual(data.correct_image().get_size(), (64, 64))
+
+
+class TestFontCache(unittest.TestCase):
+
+    def setUp(self):
+        import pygame
+        pygame.font.init()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self._file_name = os.path.join(tmp.name, 'fonts.json')
+        self._font_file = os.path.join(tmp.name, 'font.ttf')
+        with open(self._font_file, 'wb') as font_file:
+            font_file.write(b'')
+
+    def _font(self, match_font_result, name='monospace'):
+        import pygame
+        cache = tabliczka.FontCache(self._file_name)
+        with unittest.mock.patch.object(pygame.font, 'match_font', return_value=match_font_result) as match_font, \
+                unittest.mock.patch.object(pygame.font, 'Font') as font:
+            cache.font(name, 20)
+        cache.save()
+        return match_font.call_count, font.call_args[0][0]
+
+    def test_cached(self):
+        self.assertEqual(self._font(self._font_file), (1, self._font_file))
+        self.assertEqual(self._font(None), (0, self._font_file))
+        self.assertEqual(self._font(None, 'serif'), (1, None))
+        self.assertEqual(self._font(self._font_file, 'serif'), (0, None))
+
+    def test_font_removed(self):
+        self._font(self._font_file)
+        os.remove(self._font_file)
+        self.assertEqual(self._font(None), (1, None))
+
+    def test_fonts_changed(self):
+        self._font(self._font_file)
+        with unittest.mock.patch.object(tabliczka, '_font_fingerprint', return_value=['changed']):
+            self.assertEqual(self._font(None), (1, None))
+
+
+class TestGUI(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        patcher = unittest.mock.patch.dict(os.environ, SDL_VIDEODRIVER='dummy')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = unittest.mock.patch.object(tabliczka, '_font_cache_filename', os.path.join(tmp.name, 'fonts.json'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_prefetch(self):
+        import pygame
+        args = tabliczka.get_argument_parser().parse_args(['--prefetch', '--no-show-scores'])
+        state = tabliczka.State()
+        with tabliczka.GUI(tabliczka.Settings(NoFS(), args)) as gui:
+            problem = state.generate_problem(gui.answer_count())
+            pygame.event.post(pygame.event.Event(pygame.KEYDOWN, key=pygame.K_UP, unicode=''))
+            gui.solve_problem(problem, state)
+            prepared, frame, _ = gui._prepared
+            self.assertIs(prepared, state.prefetch_problem(gui.answer_count()))
+            state.update_from(problem)
+            self.assertIs(state.generate_problem(gui.answer_count()), prepared)
+            gui._display_problem(prepared, state)
+            self.assertIsNone(gui._prepared)
+            self.assertEqual(pygame.image.tostring(gui._screen, 'RGB'), pygame.image.tostring(frame, 'RGB'))
+
+    def test_event_driven(self):
+        import pygame
+        args = tabliczka.get_argument_parser().parse_args(['--no-show-scores', '--show-feedback'])
+        state = tabliczka.State()
+        with tabliczka.GUI(tabliczka.Settings(NoFS(), args)) as gui:
+            self.assertTrue(pygame.event.get_blocked(pygame.MOUSEMOTION))
+            problem = state.generate_problem(gui.answer_count())
+            pygame.event.post(pygame.event.Event(pygame.KEYDOWN, key=pygame.K_SPACE, unicode=' '))
+            pygame.event.post(pygame.event.Event(pygame.KEYDOWN, key=pygame.K_UP, unicode=''))
+            gui.solve_problem(problem, state)
+            self.assertEqual(problem._answer_text, problem.answers()[0])
+            self.assertGreaterEqual(gui.waiting_cpu_sec_per_minute(), 0)
+            # A timer event left over from earlier feedback must not end the next one early.
+            pygame.event.post(pygame.event.Event(gui._feedback_timeout_event))
+            pygame.event.post(pygame.event.Event(gui._feedback_timeout_event))
+            start = time.monotonic()
+            gui.provide_feedback(problem, state)
+            self.assertLess(time.monotonic() - start, tabliczka._ERROR_FEEDBACK_DELAY_MILLISEC / 1000)
+            self.assertFalse(pygame.event.peek(gui._feedback_timeout_event))
+
+    def test_prerender(self):
+        for max_factor, expected in ((10, 42 + 100), (100, tabliczka._TEXT_CACHE_SIZE)):
+            args = tabliczka.get_argument_parser().parse_args(['--prerender', '--no-show-scores', '--max-factor', str(max_factor)])
+            with tabliczka.GUI(tabliczka.Settings(NoFS(), args)) as gui:
+                self.assertEqual(len(gui._text_cache._surfaces), expected)
+
+    def test_answer_timed_from_display(self):
+        import pygame
+        args = tabliczka.get_argument_parser().parse_args(['--prefetch', '--no-show-scores'])
+        state = tabliczka.State()
+        with tabliczka.GUI(tabliczka.Settings(NoFS(), args)) as gui:
+            problem = state.generate_problem(gui.answer_count())
+            prepare = gui._prepare
+
+            def slow_prepare(next_problem):
+                time.sleep(0.2)
+                prepare(next_problem)
+            gui._prepare = slow_prepare
+            pygame.event.post(pygame.event.Event(pygame.KEYDOWN, key=pygame.K_UP, unicode=''))
+            gui.solve_problem(problem, state)
+            self.assertGreaterEqual(problem.answer_delay(), 0.2)
+
+    def test_feedback_dismissed(self):
+        import pygame
+        args = tabliczka.get_argument_parser().parse_args(['--no-show-scores', '--show-feedback'])
+        state = tabliczka.State()
+        with tabliczka.GUI(tabliczka.Settings(NoFS(), args)) as gui:
+            problem = state.generate_problem(gui.answer_count())
+            problem.answered('0', 0)
+            state.update_from(problem)
+            pygame.event.post(pygame.event.Event(pygame.KEYDOWN, key=pygame.K_SPACE, unicode=' '))
+            pygame.event.post(pygame.event.Event(pygame.KEYDOWN, key=pygame.K_LEFT, unicode=''))
+            start = time.monotonic()
+            gui.provide_feedback(problem, state)
+            self.assertLess(time.monotonic() - start, tabliczka._ERROR_FEEDBACK_DELAY_MILLISEC / 1000)
+            self.assertIs(gui._prepared[0], state.prefetch_problem(gui.answer_count()))
+
+
+class TestTUI(unittest.TestCase):
+
+    class Screen:
+
+        def __init__(self, keys):
+            self.keys = keys
+            self.written = []
+
+        def getmaxyx(self):
+            return 24, 80
+
+        def addstr(self, y, x, text, attr):
+            self.written.append((y, x, text))
+
+        def refresh(self):
+            pass
+
+        def getch(self):
+            return self.keys.pop(0) if self.keys else -1
+
+        def timeout(self, delay):
+            pass
+
+        def clear(self):
+            pass
+
+    def _tui(self, keys, *args):
+        tui = tabliczka.TUI(tabliczka.Settings(NoFS(), tabliczka.get_argument_parser().parse_args(list(args))))
+        tui._screen = self.Screen(keys)
+        return tui
+
+    def test_layout(self):
+        import curses
+        tui = self._tui([ord('x'), curses.KEY_RIGHT, ord('A')])
+        state = tabliczka.State()
+        problem = tabliczka.Problem(3, 4, 4)
+        problem._answers = ['9', '12', '16', '8']
+        tui.solve_problem(problem, state)
+        self.assertEqual(tui._screen.written, [
+            (12, 36, '3 * 4 = ?'), (10, 40, '9'), (12, 49, '12'), (14, 39, '16'), (12, 31, '8'),
+            (23, 0, ':-) 0'), (23, 74, '0 :-(')])
+        self.assertTrue(problem.answered_correctly())
+        problem.answered('0', 0)
+        state.update_from(problem)
+        tui._screen.written.clear()
+        tui.solve_problem(problem, state)
+        self.assertEqual(tui._screen.written, [(23, 74, '1 :-(')])
+        self.assertEqual(problem.answer_number(), 8)
+
+    def test_redraw(self):
+        tui = self._tui([ord('w')], '--answer-scheme', 'EW', '--no-show-scores')
+        problem = tabliczka.Problem(10, 10, 2)
+        problem._answers = ['90', '110']
+        tui._display_problem(problem, None)
+        problem = tabliczka.Problem(2, 3, 2)
+        problem._answers = ['6', '8']
+        tui._screen.written.clear()
+        tui._display_problem(problem, None)
+        self.assertEqual(tui._screen.written, [
+            (12, 35, '           '), (12, 50, '  '), (12, 28, '   '),
+            (12, 36, '2 * 3 = ?'), (12, 49, '6'), (12, 31, '8')])
+
+    def test_answer_time(self):
+        tui = self._tui([], '--show-feedback')
+        state = tabliczka.State()
+        problem = tabliczka.Problem(3, 4, 4)
+        tui._screen.keys = [-1, ord('s')]
+        tui.solve_problem(problem, state)
+        self.assertLess(problem.answer_delay(), 1)
+        problem.answered('0', 0)
+        tui._screen.keys = [ord('d')]
+        start = time.monotonic()
+        tui.provide_feedback(problem, state)
+        self.assertLess(time.monotonic() - start, tabliczka._ERROR_FEEDBACK_DELAY_MILLISEC / 1000)
+        tui._screen.keys = [ord('q')]
+        self.assertRaises(tabliczka.QuitException, tui.solve_problem, problem, state)
+
+
+class TestTrace(unittest.TestCase):
+
+    def test_disabled(self):
+        self.assertIsNone(tabliczka._tracer)
+        self.assertIs(tabliczka._trace('load'), tabliczka._trace('save'))
+
+    def test_session(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            trace_file = os.path.join(tmp, 'trace.json')
+            script = 'import sys, tabliczka; sys.argv[1:] = %r; tabliczka.main()' % (
+                    ['--ui', 'cli', '--limit', '1', '--trace', trace_file],)
+            subprocess.run([sys.executable, '-c', script], input='0\n', capture_output=True, text=True, check=True,
+                    cwd=os.path.dirname(os.path.abspath(tabliczka.__file__)), env=dict(os.environ, XDG_STATE_HOME=tmp))
+            with open(trace_file) as f:
+                events = json.load(f)['traceEvents']
+        self.assertEqual(set(e['name'] for e in events),
+                {'settings', 'load', 'generate_problem', 'problem', 'input', 'update_from', 'save', 'write'})
+        for event in events:
+            self.assertEqual(event['ph'], 'X')
+            self.assertGreaterEqual(event['dur'], 0)
+
+
+class TestRecordReplay(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self._recording_file = os.path.join(tmp.name, 'session.json')
+        for patcher in (unittest.mock.patch.dict(os.environ, SDL_VIDEODRIVER='dummy'),
+                        unittest.mock.patch.object(tabliczka, '_font_cache_filename', os.path.join(tmp.name, 'fonts.json'))):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _record(self, *args):
+        import pygame
+        settings = tabliczka.Settings(tabliczka.MemoryFS(), tabliczka.get_argument_parser().parse_args(['--no-show-scores', *args]))
+        state = tabliczka.State(max_factor=4)
+        state._storage = tabliczka.DiscardingStorage()
+        real_wait = pygame.event.wait
+        keys = [pygame.K_UP, pygame.K_DOWN, pygame.K_LEFT, pygame.K_RIGHT] * 5
+        events = [pygame.event.Event(pygame.KEYDOWN, key=k, unicode='') for k in keys] + [pygame.event.Event(pygame.QUIT)]
+
+        def wait():
+            # The event queue is set up once the display is.
+            return events.pop(0) if events else real_wait()
+        with unittest.mock.patch.object(pygame.event, 'wait', wait):
+            tabliczka.record_session(settings, state, self._recording_file)
+        return state
+
+    def test_replay(self):
+        state = self._record('--scheduler', 'due', '--prefetch')
+        self.assertGreater(state.correct_count() + state.error_count(), 0)
+        matches, frame_count, display_sec = tabliczka.replay_session(self._recording_file)
+        self.assertTrue(matches)
+        self.assertGreaterEqual(frame_count, state.correct_count() + state.error_count())
+        self.assertGreater(display_sec, 0)
+
+    def test_replay_differs(self):
+        self._record()
+        with open(self._recording_file) as recording_file:
+            recording = json.load(recording_file)
+        recording['final_state']['correct_count'] += 1
+        with open(self._recording_file, 'w') as recording_file:
+            json.dump(recording, recording_file)
+        self.assertFalse(tabliczka.replay_session(self._recording_file)[0])
+
+
+class TestMetrics(unittest.TestCase):
+
+    def _metrics(self):
+        metrics = tabliczka.Metrics()
+        state = tabliczka.State()
+        state._correct_count = 3
+        metrics.watch(state)
+        for _ in range(2):
+            with metrics.span('update_from'):
+                pass
+        metrics._histograms['render'].observe(0.003)
+        metrics._histograms['render'].observe(2)
+        return metrics
+
+    def test_text(self):
+        lines = self._metrics().text().splitlines()
+        self.assertIn('tabliczka_answers_total 2', lines)
+        self.assertIn('tabliczka_correct_answers_total 3', lines)
+        self.assertIn('tabliczka_error_answers_total 0', lines)
+        self.assertIn('tabliczka_stage_seconds_bucket{stage="render",le="0.0025"} 0', lines)
+        self.assertIn('tabliczka_stage_seconds_bucket{stage="render",le="0.005"} 1', lines)
+        self.assertIn('tabliczka_stage_seconds_bucket{stage="render",le="1"} 1', lines)
+        self.assertIn('tabliczka_stage_seconds_bucket{stage="render",le="+Inf"} 2', lines)
+        self.assertIn('tabliczka_stage_seconds_count{stage="render"} 2', lines)
+        self.assertIn('tabliczka_stage_seconds_sum{stage="render"} 2.003', lines)
+        if sys.platform.startswith('linux'):
+            self.assertTrue(any(line.startswith('process_resident_memory_bytes ') for line in lines))
+
+    def test_http(self):
+        import urllib.request
+        metrics = self._metrics()
+        metrics.export(port=0)
+        self.addCleanup(metrics.stop)
+        with urllib.request.urlopen('http://localhost:%d/metrics' % metrics.port()) as response:
+            self.assertIn(b'tabliczka_answers_total 2\n', response.read())
+
+    def test_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            file_name = os.path.join(tmp, 'metrics.prom')
+            metrics = self._metrics()
+            metrics.export(file_name=file_name)
+            metrics.stop()
+            with open(file_name) as metrics_file:
+                self.assertIn('tabliczka_answers_total 2\n', metrics_file.read())
+
+    def test_with_tracer(self):
+        metrics = tabliczka.Metrics()
+        tracer = tabliczka.Tracer()
+        recorder = tabliczka._span_recorder(tracer, metrics)
+        with recorder.span('save'):
+            pass
+        self.assertEqual(metrics._histograms['save'].count, 1)
+        self.assertEqual(len(tracer._spans), 1)
+        self.assertIs(tabliczka._span_recorder(None, metrics), metrics)
+        self.assertIsNone(tabliczka._span_recorder(None, None))
+
+
+class TestLazyImport(unittest.TestCase):
+
+    def _assert_no_pygame(self, *args, stdin=''):
+        with tempfile.TemporaryDirectory() as tmp:
+            script = 'import sys, tabliczka; sys.argv[1:] = %r; tabliczka.main(); print("pygame" in sys.modules)' % (list(args),)
+            result = subprocess.run([sys.executable, '-c', script], input=stdin, capture_output=True, text=True, check=True,
+                    cwd=os.path.dirname(os.path.abspath(tabliczka.__file__)), env=dict(os.environ, XDG_STATE_HOME=tmp))
+        self.assertEqual(result.stdout.splitlines()[-1], 'False')
+
+    def test_dump(self):
+        self._assert_no_pygame('--dump')
+
+    def test_cli(self):
+        self._assert_no_pygame('--ui', 'cli', '--limit', '1', stdin='0\n')
+
+    def test_tui(self):
+        self.assertIs(tabliczka.get_ui_class('tui'), tabliczka.TUI)
+        self._assert_no_pygame('--dump', '--ui', 'tui')
+
+
 if __name__ == '__main__':
     unittest.main()